@@ -1,11 +1,12 @@
 import streamlit as st
 import os
-import time
 import uuid
 from dotenv import load_dotenv
 from tavily import TavilyClient
 import google.generativeai as genai
 import re
+from backend.context import build_context, build_history
+from backend.ratelimit import get_limiter, parse_retry_after
 
 # --- 1. SETUP, SECURITY, AND RATE LIMIT TRACKING ---
 
@@ -16,13 +17,15 @@ load_dotenv()
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Define the mandatory delay based on the free tier limit (5 RPM for Pro/Flash, up to 15 RPM for Lite)
-# We use 15 seconds to be very safe against 429s
-REQUIRED_DELAY = 15
+# Process-wide quota for each upstream, shared by every browser session
+# (free tier is 5 RPM for Pro/Flash, up to 15 RPM for Lite).
+# The limiters live in an imported module, so they survive Streamlit reruns.
+gemini_limiter = get_limiter("gemini:gemini-2.5-flash-lite", float(os.getenv("GEMINI_RPM", "15")))
+tavily_limiter = get_limiter("tavily", float(os.getenv("TAVILY_RPM", "100")))
 
-# Initialize the last search time tracker in Streamlit's session state
-if 'last_search_time' not in st.session_state:
-    st.session_state.last_search_time = 0 
+# Token budgets for the RAG prompt (sources and conversation history)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1000"))
 
 # Check if keys are missing
 if not TAVILY_API_KEY or not GEMINI_API_KEY:
@@ -48,12 +51,26 @@ def search_web(query):
     We use 'advanced' depth for better quality.
     """
     try:
+        tavily_limiter.acquire_sync()
         response = tavily.search(query=query, search_depth="advanced", max_results=5)
         return response['results']
     except Exception as e:
         st.error(f"Search failed: {e}")
         return []
 
+def wait_for_quota(limiter, label):
+    """
+    Blocks until the limiter grants a slot, showing a countdown only when
+    the real quota actually makes us wait.
+    """
+    wait = limiter.predict_wait()
+    if wait > 0:
+        with st.status(f"{label} ({int(wait) + 1}s)...", expanded=False) as status:
+            limiter.acquire_sync()
+            status.update(label="Ready!", state="complete", expanded=False)
+    else:
+        limiter.acquire_sync()
+
 def extract_youtube_id(url):
     """
     Extracts the video ID from a YouTube URL.
@@ -74,19 +91,15 @@ def generate_answer(query, search_results, history=[]):
         search_results: List of sources from Tavily
         history: List of previous messages (st.session_state.messages)
     """
-    # Create a string containing all the search data (The RAG Context)
-    context_text = "\n\n".join([
-        f"Source: {r['title']}\nURL: {r['url']}\nContent: {r['content']}"
-        for r in search_results
-    ])
+    # Create a string with the most relevant search passages (The RAG Context)
+    context_text = build_context(query, search_results, budget=CONTEXT_TOKEN_BUDGET)
 
-    # Format history for the prompt
+    # Format the most recent history that fits its own budget
     history_text = ""
     if history:
-        history_text = "Conversation History:\n" + "\n".join([
-            f"{msg['role'].title()}: {msg.get('plain_text', msg['content'])}" 
-            for msg in history
-        ]) + "\n\n"
+        history_text = "Conversation History:\n" + build_history(
+            history, budget=HISTORY_TOKEN_BUDGET, text_key='plain_text'
+        ) + "\n\n"
 
     # The prompt tells Gemini how to behave
     prompt = f"""
@@ -483,15 +496,6 @@ if current_messages and current_messages[-1]["role"] == "user":
     
     last_user_query = current_messages[-1]["content"]
 
-    # Rate Limit Handling (Auto-Wait)
-    time_since_last_search = time.time() - st.session_state.last_search_time
-    
-    if time_since_last_search < REQUIRED_DELAY:
-        remaining_time = REQUIRED_DELAY - int(time_since_last_search) + 1
-        with st.status(f"Generating... might take few seconds ({remaining_time}s)...", expanded=False) as status:
-            time.sleep(remaining_time)
-            status.update(label="Ready!", state="complete", expanded=False)
-            
     # Execution
     status_container = st.empty()
     status_container.status("Searching web...", expanded=True)
@@ -562,6 +566,7 @@ if current_messages and current_messages[-1]["role"] == "user":
             full_response_text = ""
             
             # Pass all previous messages except the very last one (which is the current prompt)
+            wait_for_quota(gemini_limiter, "Generating... waiting for API quota")
             stream = generate_answer(last_user_query, results, current_messages[:-1])
             
             for chunk in stream:
@@ -581,13 +586,13 @@ if current_messages and current_messages[-1]["role"] == "user":
                 "content": final_history_html,
                 "plain_text": full_response_text
             })
-            st.session_state.last_search_time = time.time()
             st.rerun() # Rerun to solidify the state and remove the "Thinking" UI from the loop
             
         else:
             st.warning("No results found.")
     except Exception as e:
-        # Robust error handling for Quota Exceeded with Exponential Backoff
+        # Quota exceeded: block the shared limiter for as long as the API asks
+        # (falling back to 10s/20s/30s when it gives no hint) and retry through it
         error_str = str(e)
         if "429" in error_str or "Quota exceeded" in error_str:
             st.warning("⚠️ Quota exceeded. Attempting auto-retry (up to 3 times)...")
@@ -595,11 +600,10 @@ if current_messages and current_messages[-1]["role"] == "user":
             retry_count = 0
             max_retries = 3
             success = False
+            gemini_limiter.penalize(parse_retry_after(body=error_str) or 10)
             
             while retry_count < max_retries and not success:
-                wait_time = (retry_count + 1) * 10 # 10s, 20s, 30s
-                with st.spinner(f"Waiting {wait_time}s to cooldown..."):
-                    time.sleep(wait_time)
+                wait_for_quota(gemini_limiter, "Waiting for quota to cool down")
                 
                 try:
                     stream = generate_answer(last_user_query, results, current_messages[:-1])
@@ -621,11 +625,11 @@ if current_messages and current_messages[-1]["role"] == "user":
                         "content": final_history_html,
                         "plain_text": full_response_text
                     })
-                    st.session_state.last_search_time = time.time()
                     st.rerun()
                     success = True
                 except Exception as retry_e:
                     retry_count += 1
+                    gemini_limiter.penalize(parse_retry_after(body=str(retry_e)) or (retry_count + 1) * 10)
                     if retry_count == max_retries:
                          st.error(f"Failed after retries. Please wait a minute before asking again. (API Quota)")
         else:
@@ -0,0 +1,143 @@
+import os
+import math
+import time
+import asyncio
+from collections import deque
+import metrics
+
+# Caps how many chat generations run at once. Past the cap, requests wait
+# in a bounded queue with a deadline; when the queue is full (or the wait
+# runs out) they're turned away at once with a Retry-After estimate, so a
+# spike degrades into some fast 429s instead of every upstream call failing
+# together. Short follow-ups get their own lane that is served first.
+
+MAX_INFLIGHT_GENERATIONS = int(os.getenv("MAX_INFLIGHT_GENERATIONS", "32"))  # 0 disables
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Follow-ups at most this many words go in the priority lane
+ADMISSION_SHORT_WORDS = int(os.getenv("ADMISSION_SHORT_WORDS", "12"))
+# After this many priority grants in a row a waiting normal request goes next
+ADMISSION_PRIORITY_BURST = int(os.getenv("ADMISSION_PRIORITY_BURST", "4"))
+
+LANES = ("priority", "normal")
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server busy ({reason}), retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+def lane_for(message, has_history):
+    """Short follow-ups are cheap to answer and someone is mid-conversation."""
+    if has_history and len(message.split()) <= ADMISSION_SHORT_WORDS:
+        return "priority"
+    return "normal"
+
+class AdmissionController:
+    def __init__(self, max_inflight=MAX_INFLIGHT_GENERATIONS, max_queue=ADMISSION_QUEUE_SIZE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT, priority_burst=ADMISSION_PRIORITY_BURST):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.priority_burst = priority_burst
+        self.inflight = 0
+        self.queues = {lane: deque() for lane in LANES}  # lane -> waiting futures
+        self.priority_streak = 0
+        self.avg_duration = 10.0  # EWMA of generation time, for Retry-After
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0}
+
+    def queued(self, lane=None):
+        lanes = [lane] if lane else LANES
+        return sum(1 for l in lanes for f in self.queues[l] if not f.done())
+
+    def retry_after(self):
+        # Time for the queue ahead (plus us) to drain at the current pace
+        waiting = self.queued() + 1
+        return max(1, math.ceil(self.avg_duration * waiting / max(1, self.max_inflight)))
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        metrics.ADMISSION_REJECTED.labels(reason).inc()
+        raise Overloaded(reason, self.retry_after())
+
+    def _update_gauges(self):
+        metrics.ADMISSION_INFLIGHT.set(self.inflight)
+        for lane in LANES:
+            metrics.ADMISSION_QUEUED.labels(lane).set(self.queued(lane))
+
+    async def acquire(self, lane="normal"):
+        """Waits for a generation slot; raises Overloaded instead of waiting too long."""
+        if self.max_inflight <= 0:
+            return
+        start = time.monotonic()
+        if self.inflight < self.max_inflight and not self.queued():
+            self.inflight += 1
+        else:
+            if self.queued() >= self.max_queue:
+                self._reject("queue_full")
+            future = asyncio.get_running_loop().create_future()
+            self.queues[lane].append(future)
+            self._update_gauges()
+            try:
+                # release() hands its slot straight to us, so inflight is already counted
+                await asyncio.wait_for(future, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._discard(lane, future)
+                self._reject("timeout")
+            except asyncio.CancelledError:
+                # Client left while queued; if a slot was just handed over, pass it on
+                if future.done() and not future.cancelled():
+                    self.release()
+                self._discard(lane, future)
+                raise
+        self.admitted += 1
+        metrics.ADMISSION_WAIT.labels(lane).observe(time.monotonic() - start)
+        self._update_gauges()
+
+    def _discard(self, lane, future):
+        try:
+            self.queues[lane].remove(future)
+        except ValueError:
+            pass
+        self._update_gauges()
+
+    def _next_waiter(self):
+        order = LANES
+        if self.priority_streak >= self.priority_burst and self.queued("normal"):
+            order = ("normal", "priority")
+        for lane in order:
+            queue = self.queues[lane]
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    self.priority_streak = self.priority_streak + 1 if lane == "priority" else 0
+                    return future
+        return None
+
+    def release(self, duration=None):
+        """Frees a slot, handing it to the next waiter if there is one."""
+        if self.max_inflight <= 0:
+            return
+        if duration is not None:
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+        waiter = self._next_waiter()
+        if waiter is not None:
+            waiter.set_result(True)
+        else:
+            self.inflight -= 1
+        self._update_gauges()
+
+    def stats(self):
+        return {
+            "max_inflight": self.max_inflight,
+            "inflight": self.inflight,
+            "queued": {lane: self.queued(lane) for lane in LANES},
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "avg_generation_seconds": round(self.avg_duration, 2),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
+
+admission = AdmissionController()
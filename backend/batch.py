@@ -0,0 +1,150 @@
+"""
+Runs a JSONL file of questions through the answer pipeline (rewrite,
+search, generation) with bounded concurrency, for offline evaluation.
+
+Each input line is {"id": ..., "question": "...", "multi_query": bool,
+"history": [...]} (only "question" is required; a bare JSON string works
+too). Results are written as NDJSON in completion order:
+
+    python batch.py questions.jsonl --out results.ndjson --concurrency 16
+    curl -X POST 'localhost:8005/api/batch?concurrency=16' --data-binary @questions.jsonl
+
+Runs share the search/answer caches, rate limiters and model router with
+the rest of the process. Sessions are only written with --persist.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from datetime import datetime
+import metrics
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "64"))
+
+def parse_items(lines):
+    """Yields one item per non-blank line; malformed lines become items with an "error"."""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            yield {"id": number, "error": f"invalid JSON: {e}"}
+            continue
+        if isinstance(item, str):
+            item = {"question": item}
+        if not isinstance(item, dict) or not (item.get("question") or item.get("message")):
+            yield {"id": number, "error": "missing question"}
+            continue
+        item.setdefault("id", number)
+        yield item
+
+async def _persist(question, answer, sources):
+    # Imported here so the CLI doesn't need Mongo unless --persist is given
+    from database import create_session, begin_turn, save_message
+    session = await create_session({"title": " ".join(question.split()[:5]), "created_at": datetime.utcnow()})
+    reply_seq = await begin_turn(session["id"], {"role": "user", "content": question})
+    if reply_seq is not None:
+        await save_message(session["id"], reply_seq, {
+            "role": "assistant", "content": answer, "sources": sources, "status": "complete",
+        })
+    return session["id"]
+
+async def answer_one(item, persist=False):
+    """Runs one item through the pipeline and returns its result record."""
+    # Imported lazily: services prints at import time, before the CLI redirects stdout
+    from services import answer_stream, ERROR_MARKER
+    if "error" in item:
+        return {"id": item["id"], "status": "invalid", "error": item["error"]}
+    question = item.get("question") or item.get("message")
+    result = {"id": item["id"], "question": question}
+    start = time.perf_counter()
+    answer, sources = "", []
+    with metrics.timings_scope() as timings:
+        try:
+            async for kind, data in answer_stream(question, item.get("history") or [], item.get("multi_query")):
+                if kind == "sources":
+                    sources = data
+                else:
+                    answer += data
+            result["status"] = "error" if ERROR_MARKER in answer else "ok"
+            if persist and result["status"] == "ok":
+                result["session_id"] = await _persist(question, answer, sources)
+        except Exception as e:
+            result.update(status="error", error=str(e))
+    result.update(
+        answer=answer,
+        sources=[{"title": s.get("title"), "url": s.get("url"), "score": s.get("score")} for s in sources],
+        seconds=round(time.perf_counter() - start, 3),
+        timings={stage: round(sec * 1000, 1) for stage, sec in metrics.stage_totals(timings).items()},
+    )
+    return result
+
+async def run_batch(items, concurrency=BATCH_CONCURRENCY, persist=False):
+    """
+    Async generator of result records, yielded as each item finishes.
+    A fixed pool of `concurrency` workers pulls from `items`, so memory
+    stays flat however long the input is.
+    """
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    items = iter(items)
+    results = asyncio.Queue()
+
+    async def worker():
+        for item in items:
+            await results.put(await answer_one(item, persist))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    finished = asyncio.gather(*workers)
+    finished.add_done_callback(lambda _: results.put_nowait(None))
+    try:
+        while (result := await results.get()) is not None:
+            yield result
+        await finished  # surfaces a worker crash
+    finally:
+        for task in workers:
+            task.cancel()
+
+async def _main(args, out):
+    from services import init_http_client, close_http_client
+    init_http_client()
+    counts, started = {}, time.perf_counter()
+    try:
+        with open(args.input) as f:
+            async for result in run_batch(parse_items(f), args.concurrency, args.persist):
+                out.write(json.dumps(result, default=str) + "\n")
+                out.flush()
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+    finally:
+        await close_http_client()
+        if args.persist:
+            # Flushes the last write-behind batch before asyncio.run cancels it
+            from database import close_db
+            await close_db()
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    print(f"{total} questions in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.2f}/s): {counts}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions")
+    parser.add_argument("input", help="JSONL file, one question per line")
+    parser.add_argument("--out", help="Write NDJSON results here (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--persist", action="store_true", help="Save each answer as a chat session")
+    args = parser.parse_args()
+    # The pipeline logs with print(); keep stdout for results only
+    out = open(args.out, "w") if args.out else sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            asyncio.run(_main(args, out))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import re
+import time
+import random
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+def _being_cancelled():
+    task = asyncio.current_task()
+    cancelling = getattr(task, "cancelling", None)
+    return bool(cancelling and cancelling())
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries also expire after `ttl` seconds.
+    get_or_fetch adds single-flight: concurrent misses on the same key
+    share one upstream call instead of each firing their own.
+    """
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.inflight = {}         # key -> asyncio.Future
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    def lookup(self, key):
+        """get() that counts as a hit or a miss, for callers that fetch on a miss themselves."""
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    async def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached value for key, or awaits fetch() to produce it.
+        fetch should raise on failure; failures are shared with waiters but not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # The leader was cancelled (e.g. its client left), not us: take over
+                if pending.cancelled() and not _being_cancelled():
+                    return await self.get_or_fetch(key, fetch)
+                raise
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            value = await fetch()
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting; mark the exception as retrieved
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "inflight": len(self.inflight),
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "to", "of", "in", "on", "for",
+    "and", "or", "me", "my", "i", "you", "your", "please", "can", "could", "would",
+    "what", "whats", "tell", "about", "do", "does", "how", "with", "some", "give",
+}
+_MERSENNE_PRIME = (1 << 61) - 1
+
+def _shingles(text):
+    """Word unigrams + bigrams of the normalized question, minus filler words."""
+    words = [w for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in _STOPWORDS]
+    shingles = set(words)
+    shingles.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    return shingles
+
+def _jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+class AnswerCache:
+    """
+    Near-duplicate cache for first-turn answers.
+    Questions are MinHashed and bucketed with LSH so a paraphrase finds its
+    neighbours without scanning every entry; candidates are then verified
+    with exact Jaccard on the question shingles and on the source URL sets.
+    """
+    def __init__(self, maxsize=512, ttl=3600, threshold=0.7, url_threshold=0.5,
+                 num_perm=64, bands=16):
+        assert num_perm % bands == 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.url_threshold = url_threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(1234)
+        self.perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                      for _ in range(num_perm)]
+        self.entries = OrderedDict()  # id -> entry dict
+        self.buckets = {}             # (band, band_hash) -> set of ids
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _signature(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+                  for s in shingles] or [0]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self.perms]
+
+    def _band_keys(self, signature):
+        return [(i, hash(tuple(signature[i * self.rows:(i + 1) * self.rows])))
+                for i in range(self.bands)]
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in entry["bands"]:
+            ids = self.buckets.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self.buckets[key]
+
+    def lookup(self, question, urls):
+        shingles = _shingles(question)
+        urls = set(urls)
+        signature = self._signature(shingles)
+        now = time.monotonic()
+
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+
+        best, best_score = None, 0.0
+        for entry_id in candidates:
+            entry = self.entries.get(entry_id)
+            if entry is None:
+                continue
+            if entry["expires_at"] < now:
+                self._remove(entry_id)
+                continue
+            score = _jaccard(shingles, entry["shingles"])
+            if score >= self.threshold and score > best_score \
+                    and _jaccard(urls, entry["urls"]) >= self.url_threshold:
+                best, best_score = entry_id, score
+
+        if best is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(best)
+        return self.entries[best]["answer"]
+
+    def store(self, question, urls, answer):
+        shingles = _shingles(question)
+        if not shingles:
+            return
+        signature = self._signature(shingles)
+        entry_id = self.next_id
+        self.next_id += 1
+        bands = self._band_keys(signature)
+        self.entries[entry_id] = {
+            "shingles": shingles,
+            "urls": set(urls),
+            "answer": answer,
+            "bands": bands,
+            "expires_at": time.monotonic() + self.ttl,
+        }
+        for key in bands:
+            self.buckets.setdefault(key, set()).add(entry_id)
+        while len(self.entries) > self.maxsize:
+            self._remove(next(iter(self.entries)))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,112 @@
+import asyncio
+from tasks import spawn
+
+class Broadcast:
+    """
+    Fans one producer's items out to any number of subscribers.
+    Every item is kept until the producer finishes, so a subscriber that
+    joins mid-stream is first replayed everything it missed.
+    """
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.claims = 0  # requests attached, counted before they start iterating
+        self.changed = asyncio.Condition()
+
+    async def publish(self, item):
+        async with self.changed:
+            self.items.append(item)
+            self.changed.notify_all()
+
+    async def finish(self, error=None):
+        async with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        try:
+            position = 0
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: position < len(self.items) or self.done)
+                    batch = self.items[position:]
+                    position = len(self.items)
+                    finished, error = self.done, self.error
+                for item in batch:
+                    yield item
+                if finished and position == len(self.items):
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self.subscribers -= 1
+
+class Coalescer:
+    """
+    Attaches identical requests to the one already in flight.
+    The first request for a key starts the producer as a background task;
+    later ones with the same key subscribe to its Broadcast instead of
+    doing the work again. The key is dropped once the producer finishes,
+    and the producer is cancelled if every request attached to it leaves.
+    """
+    def __init__(self):
+        self.inflight = {}  # key -> (Broadcast, producer task)
+        self.started = 0
+        self.joined = 0
+        self.abandoned = 0
+
+    async def _produce(self, key, broadcast, producer):
+        try:
+            async for item in producer:
+                await broadcast.publish(item)
+        except asyncio.CancelledError:
+            await broadcast.finish(asyncio.CancelledError())
+            raise
+        except Exception as e:
+            await broadcast.finish(e)
+        else:
+            await broadcast.finish()
+        finally:
+            if self.inflight.get(key, (None,))[0] is broadcast:
+                del self.inflight[key]
+
+    async def _follow(self, broadcast, task):
+        try:
+            async for item in broadcast.subscribe():
+                yield item
+        finally:
+            broadcast.claims -= 1
+            if broadcast.claims == 0 and not broadcast.done:
+                # Nobody is left to read the answer
+                self.abandoned += 1
+                task.cancel()
+
+    def subscribe(self, key, make_producer):
+        """
+        Returns an async iterator over the items for key.
+        make_producer() is only called if nothing is in flight for key.
+        """
+        entry = self.inflight.get(key)
+        if entry is None:
+            broadcast = Broadcast()
+            self.started += 1
+            task = spawn(self._produce(key, broadcast, make_producer()))
+            entry = self.inflight[key] = (broadcast, task)
+        else:
+            self.joined += 1
+        broadcast, task = entry
+        broadcast.claims += 1
+        return self._follow(broadcast, task)
+
+    def stats(self):
+        return {
+            "inflight": len(self.inflight),
+            "subscribers": sum(b.subscribers for b, _ in self.inflight.values()),
+            "started": self.started,
+            "joined": self.joined,
+            "abandoned": self.abandoned,
+        }
@@ -0,0 +1,107 @@
+import re
+import hashlib
+
+# Prompt assembly under a token budget.
+# Kept free of other backend imports so app.py can use it too.
+
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    """Cheap local estimate (~4 chars per token for English); no tokenizer needed."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def _words(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def split_passages(text, target_chars=700):
+    """Splits a source into paragraph-aligned passages of roughly target_chars."""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n|(?<=[.!?])\s+(?=[A-Z])", text or "") if p.strip()]
+    passages, current = [], ""
+    for p in paragraphs:
+        # Very long paragraphs get hard-wrapped so one blob can't eat the budget
+        while len(p) > target_chars * 2:
+            cut = p.rfind(" ", 0, target_chars)
+            if cut <= 0:
+                cut = target_chars
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(p[:cut].strip())
+            p = p[cut:].strip()
+        if current and len(current) + len(p) > target_chars:
+            passages.append(current)
+            current = p
+        else:
+            current = f"{current} {p}".strip()
+    if current:
+        passages.append(current)
+    return passages
+
+def overlap_score(query, passages):
+    """Default relevance: fraction of query terms present in each passage."""
+    terms = set(_words(query))
+    if not terms:
+        return [0.0] * len(passages)
+    return [len(terms & set(_words(p))) / len(terms) for p in passages]
+
+def build_context(query, search_results, budget=3000, score_fn=overlap_score, target_chars=700):
+    """
+    Returns the "Source/URL/Content" context block for the prompt, limited to
+    `budget` estimated tokens. Sources are split into passages, duplicate
+    passages dropped, and the most relevant ones kept; kept passages are then
+    regrouped under their source in the original result order.
+    """
+    passages = []  # (result_index, passage_index, text)
+    seen = set()
+    for i, r in enumerate(search_results):
+        for j, p in enumerate(split_passages(r.get('content', ''), target_chars)):
+            digest = hashlib.md5(" ".join(_words(p)).encode()).hexdigest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            passages.append((i, j, p))
+
+    scores = score_fn(query, [p for _, _, p in passages]) if passages else []
+    # Ties keep search rank order, so Tavily's ranking still counts
+    ranked = sorted(range(len(passages)), key=lambda k: (-scores[k], passages[k][0], passages[k][1]))
+
+    used = 0
+    chosen = {}  # result_index -> [(passage_index, text)]
+    for k in ranked:
+        i, j, p = passages[k]
+        header_cost = 0
+        if i not in chosen:
+            r = search_results[i]
+            header_cost = estimate_tokens(f"Source: {r.get('title', '')}\nURL: {r.get('url', '')}\nContent: ")
+        cost = estimate_tokens(p) + header_cost
+        if used + cost > budget:
+            continue
+        used += cost
+        chosen.setdefault(i, []).append((j, p))
+
+    blocks = []
+    for i in sorted(chosen):
+        r = search_results[i]
+        content = " ... ".join(p for _, p in sorted(chosen[i]))
+        blocks.append(f"Source: {r.get('title', '')}\nURL: {r.get('url', '')}\nContent: {content}")
+    return "\n\n".join(blocks)
+
+def build_history(history, budget=1000, text_key="content", max_message_tokens=None):
+    """
+    Returns "Role: text" lines for the most recent messages that fit in
+    `budget` estimated tokens, oldest first. `text_key` lets callers prefer
+    a plain-text field over rendered content; `max_message_tokens` clips
+    each message so one long answer can't crowd out everything before it.
+    """
+    lines, used = [], 0
+    for msg in reversed(history or []):
+        text = msg.get(text_key) or msg.get('content', '')
+        if max_message_tokens and estimate_tokens(text) > max_message_tokens:
+            text = text[:max_message_tokens * CHARS_PER_TOKEN].rsplit(" ", 1)[0] + " ..."
+        line = f"{msg['role'].title()}: {text}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        used += cost
+        lines.append(line)
+    return "\n".join(reversed(lines))
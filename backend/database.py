@@ -1,6 +1,15 @@
 import os
+import base64
+import asyncio
+import time
+import hashlib
+from datetime import datetime
 import motor.motor_asyncio
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from cache import TTLCache
+from context import estimate_tokens
+from metrics import span, timed, register_cache
 # from dotenv import load_dotenv
 
 # load_dotenv()
@@ -9,59 +18,618 @@ MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
 db = client.perplexity_clone
 sessions_collection = db.get_collection("sessions")
+# One document per message, keyed by (session_id, seq), so a long
+# conversation no longer grows a single session document without bound.
+messages_collection = db.get_collection("messages")
+# Search results are stored once, keyed by a hash of their content; assistant
+# messages keep only {"id", "score"} references to them.
+sources_collection = db.get_collection("sources")
+
+# Write-through cache of recently used sessions (with their messages). Most
+# turns of a conversation hit the same worker seconds apart, so the history
+# read is usually served from memory. Writes below update cached entries in
+# place; TTL bounds how stale a session written by another worker can get.
+SESSION_CACHE_ENABLED = os.getenv("SESSION_CACHE_ENABLED", "true").lower() == "true"
+session_cache = TTLCache(
+    maxsize=int(os.getenv("SESSION_CACHE_SIZE", "256")),
+    ttl=int(os.getenv("SESSION_CACHE_TTL", "300")),
+)
+register_cache("sessions", session_cache)
+
+async def init_db():
+    """Creates the indexes the queries below rely on. Safe to call on every start."""
+    await messages_collection.create_index([("session_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+    await sessions_collection.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
 
 # Helper to format session
-def session_helper(session) -> dict:
+def session_helper(session, messages=None) -> dict:
     return {
         "id": str(session["_id"]),
         "title": session.get("title", "New Chat"),
         "created_at": session.get("created_at"),
-        "messages": session.get("messages", [])
+        # Rolling summary of messages with seq < summary_upto (see history.py)
+        "summary": session.get("summary"),
+        "summary_upto": session.get("summary_upto", 0),
+        # Sessions not yet migrated still carry their embedded array
+        "messages": messages if messages is not None else session.get("messages", [])
     }
 
+def message_helper(message) -> dict:
+    message = dict(message)
+    message.pop("_id", None)
+    message.pop("session_id", None)
+    return message
+
+async def _load_messages(session_id: ObjectId):
+    cursor = messages_collection.find({"session_id": session_id}).sort("seq", ASCENDING)
+    return await _resolve_sources([message_helper(m) async for m in cursor])
+
+def source_id(source: dict) -> str:
+    # Score depends on the query, not the page, so it stays on the reference
+    body = "\x1f".join(str(source.get(k, "")) for k in ("url", "title", "content"))
+    return hashlib.sha1(body.encode()).hexdigest()
+
+async def _store_sources(sources):
+    """Upserts sources into the shared collection in one bulk write; returns their references."""
+    refs, ops = [], {}
+    for source in sources or []:
+        sid = source_id(source)
+        refs.append({"id": sid, "score": source.get("score")})
+        if sid not in ops:
+            body = {k: v for k, v in source.items() if k != "score"}
+            ops[sid] = UpdateOne({"_id": sid}, {"$setOnInsert": {**body, "first_seen": datetime.utcnow()}}, upsert=True)
+    if ops:
+        await sources_collection.bulk_write(list(ops.values()), ordered=False)
+    return refs
+
+async def _resolve_sources(messages):
+    """Replaces source references with the full sources, for all messages in one query."""
+    ids = {ref["id"] for m in messages for ref in m.get("source_refs", [])}
+    if not ids:
+        return messages
+    found = {doc.pop("_id"): doc async for doc in sources_collection.find({"_id": {"$in": list(ids)}})}
+    for m in messages:
+        refs = m.pop("source_refs", None)
+        if refs is not None:
+            m["sources"] = [
+                {k: v for k, v in {**found[ref["id"]], "score": ref.get("score")}.items() if k != "first_seen"}
+                for ref in refs if ref["id"] in found
+            ]
+    return messages
+
+async def _stored_doc(doc: dict) -> dict:
+    """The document as written to Mongo: embedded sources become references."""
+    if "sources" not in doc:
+        return doc
+    stored = {k: v for k, v in doc.items() if k != "sources"}
+    stored["source_refs"] = await _store_sources(doc["sources"])
+    return stored
+
+@timed("db.create_session")
 async def create_session(session_data: dict) -> dict:
-    session = await sessions_collection.insert_one(session_data)
-    new_session = await sessions_collection.find_one({"_id": session.inserted_id})
-    return session_helper(new_session)
+    session_data = {k: v for k, v in session_data.items() if k != "messages"}
+    session_data.setdefault("message_count", 0)
+    result = await sessions_collection.insert_one(session_data)
+    # We already have the document; no need to read it back
+    session_data["_id"] = result.inserted_id
+    return session_helper(session_data, [])
 
-async def get_sessions():
-    sessions = []
-    async for session in sessions_collection.find().sort("created_at", -1).limit(20):
-        sessions.append(session_helper(session))
-    return sessions
+def _encode_cursor(session) -> str:
+    created_at = session.get("created_at")
+    stamp = created_at.isoformat() if isinstance(created_at, datetime) else ""
+    return base64.urlsafe_b64encode(f"{stamp}|{session['_id']}".encode()).decode()
 
+def _decode_cursor(cursor: str):
+    try:
+        stamp, _, oid = base64.urlsafe_b64decode(cursor.encode()).decode().partition("|")
+        return (datetime.fromisoformat(stamp) if stamp else None), ObjectId(oid)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+@timed("db.get_sessions")
+async def get_sessions(limit: int = 20, cursor: str = None):
+    """
+    Sidebar listing: id, title, created_at, last activity and message count only.
+    Keyset-paginated on (created_at, _id) descending; returns (sessions, next_cursor).
+    """
+    match = {}
+    if cursor:
+        created_at, oid = _decode_cursor(cursor)
+        match = {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": oid}},
+        ]}
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        # Computed server side so legacy embedded arrays are never transferred
+        {"$project": {
+            "title": 1,
+            "created_at": 1,
+            "updated_at": 1,
+            "message_count": {"$ifNull": ["$message_count", {"$size": {"$ifNull": ["$messages", []]}}]},
+        }},
+    ]
+    docs = [doc async for doc in sessions_collection.aggregate(pipeline)]
+    next_cursor = _encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    sessions = [{
+        "id": str(doc["_id"]),
+        "title": doc.get("title", "New Chat"),
+        "created_at": doc.get("created_at"),
+        "last_activity": doc.get("updated_at") or doc.get("created_at"),
+        "message_count": doc.get("message_count", 0),
+    } for doc in docs[:limit]]
+    return sessions, next_cursor
+
+def _copy_session(session):
+    # Callers keep their snapshot (main relies on it for history), and the
+    # cached list must not change under them
+    return {**session, "messages": list(session["messages"])}
+
+def _cache_put(id: str, seq: int, message: dict):
+    session = session_cache.get(id)
+    if session is None:
+        return
+    messages = session["messages"]
+    last_seq = messages[-1]["seq"] if messages else -1
+    if seq == last_seq + 1:
+        messages.append(message_helper(message))
+    elif seq == last_seq:
+        # A checkpointed reply being updated
+        messages[-1] = message_helper(message)
+    else:
+        # A gap (another worker wrote, or a reply was never saved) or out of
+        # order; reload it next time rather than serve incomplete history
+        session_cache.delete(id)
+
+@timed("db.get_session")
 async def get_session(id: str):
+    if not SESSION_CACHE_ENABLED:
+        return await _fetch_session(id)
+    session = await session_cache.get_or_fetch(id, lambda: _fetch_session(id))
+    return _copy_session(session) if session else None
+
+async def _fetch_session(id: str):
     try:
-        session = await sessions_collection.find_one({"_id": ObjectId(id)})
-        if session:
-            return session_helper(session)
-    except:
-        pass
-    return None
+        session_id = ObjectId(id)
+    except Exception:
+        return None
+    # Separate queries: a $lookup would put every message in one document
+    # and bring back the 16 MB limit that moving them out removed
+    session = await sessions_collection.find_one({"_id": session_id})
+    if not session:
+        return None
+    if "messages" in session:
+        # Legacy embedded layout: migrate this session on first touch, then
+        # read the migrated docs so every message carries its seq
+        await _migrate_session(session)
+    return session_helper(session, await _load_messages(session_id))
+
+@timed("db.get_chat_session")
+async def get_chat_session(id: str, last: int = None):
+    """
+    The session as a chat turn needs it: metadata, summary, message_count
+    and only the last `last` messages (all if None), without their sources.
+    The history endpoint keeps using get_session for the full conversation.
+    """
+    cached = session_cache.lookup(id) if SESSION_CACHE_ENABLED else None
+    if cached is not None:
+        messages = cached["messages"] if last is None else cached["messages"][-last:] if last > 0 else []
+        return {
+            **{k: v for k, v in cached.items() if k != "messages"},
+            "message_count": len(cached["messages"]),
+            "messages": [{k: v for k, v in m.items() if k != "sources"} for m in messages],
+        }
 
+    try:
+        session_id = ObjectId(id)
+    except Exception:
+        return None
+    session = await sessions_collection.find_one({"_id": session_id})
+    if not session:
+        return None
+    count = session.get("message_count", 0)
+    if "messages" in session:
+        await _migrate_session(session)
+        count = len(session["messages"])
+    cursor = messages_collection.find(
+        {"session_id": session_id}, projection={"source_refs": 0, "sources": 0}
+    ).sort("seq", DESCENDING)
+    if last is not None:
+        cursor = cursor.limit(last)
+    messages = [message_helper(m) async for m in cursor][::-1] if last != 0 else []
+    return {**session_helper(session, messages), "message_count": count}
+
+@timed("db.get_messages")
+async def get_messages(id: str, before: int = None, limit: int = 50):
+    """
+    One page of a session's messages, oldest first, ending just before seq `before`
+    (or at the latest message). Returns (messages, next_before) or None if the
+    session doesn't exist; next_before is None once the start is reached.
+    """
+    cached = session_cache.lookup(id) if SESSION_CACHE_ENABLED else None
+    if cached is not None:
+        older = [m for m in cached["messages"] if before is None or m.get("seq", 0) < before]
+        page = older[-limit:] if limit > 0 else []
+        next_before = page[0]["seq"] if len(older) > len(page) and page else None
+        return [dict(m) for m in page], next_before
+
+    try:
+        session_id = ObjectId(id)
+    except Exception:
+        return None
+    session = await sessions_collection.find_one({"_id": session_id}, projection={"_id": 1, "messages": 1})
+    if not session:
+        return None
+    if "messages" in session:
+        await _migrate_session(session)
+
+    query = {"session_id": session_id}
+    if before is not None:
+        query["seq"] = {"$lt": before}
+    cursor = messages_collection.find(query).sort("seq", DESCENDING).limit(limit + 1)
+    page = [m async for m in cursor]
+    has_more = len(page) > limit
+    page = page[:limit][::-1]
+    next_before = page[0]["seq"] if has_more and page else None
+    return await _resolve_sources([message_helper(m) for m in page]), next_before
+
+def _message_doc(session_id: ObjectId, seq: int, message: dict) -> dict:
+    return {
+        **message,
+        "session_id": session_id,
+        "seq": seq,
+        "created_at": message.get("created_at", datetime.utcnow()),
+    }
+
+async def _reserve(id: str, count: int = 1, title: str = None):
+    """
+    Reserves `count` sequence numbers on the session (optionally setting the
+    title in the same update) and returns the first one, or None if the
+    session doesn't exist.
+    """
+    session = await _reserve_seq(ObjectId(id), count, title)
+    if not session:
+        legacy = await sessions_collection.find_one({"_id": ObjectId(id), "messages": {"$exists": True}})
+        if not legacy:
+            return None
+        await _migrate_session(legacy)
+        session = await _reserve_seq(ObjectId(id), count, title)
+    return session["message_count"] - count
+
+@timed("db.add_message")
 async def add_message(id: str, message: dict):
     try:
-        await sessions_collection.update_one(
-            {"_id": ObjectId(id)},
-            {"$push": {"messages": message}}
-        )
+        # Reserve the next sequence number on the session, then store the message
+        seq = await _reserve(id)
+        if seq is None:
+            return False
+        doc = _message_doc(ObjectId(id), seq, message)
+        await messages_collection.insert_one(await _stored_doc(doc))
+        _cache_put(id, seq, doc)
         return True
     except:
         return False
 
+@timed("db.begin_turn")
+async def begin_turn(id: str, user_message: dict, title: str = None):
+    """
+    Starts a chat turn: reserves seqs for the user message and the reply,
+    sets the title if given, and stores the user message. Two writes total.
+    Returns the seq to pass to save_message for the reply, or None.
+    """
+    try:
+        seq = await _reserve(id, count=2, title=title)
+        if seq is None:
+            return None
+        doc = _message_doc(ObjectId(id), seq, user_message)
+        await messages_collection.insert_one(doc)
+        _cache_put(id, seq, doc)
+        if title is not None:
+            cached = session_cache.get(id)
+            if cached is not None:
+                cached["title"] = title
+        return seq + 1
+    except Exception as e:
+        print(f"begin_turn failed: {e}")
+        return None
+
+@timed("db.save_message")
+async def save_message(id: str, seq: int, message: dict):
+    """Stores a message at a seq reserved by begin_turn."""
+    try:
+        doc = _message_doc(ObjectId(id), seq, message)
+        stored = await _stored_doc(doc)
+        if write_behind is not None:
+            await write_behind.add(stored)
+        else:
+            # Upsert: a checkpoint may already have created the document
+            await messages_collection.update_one(
+                {"session_id": stored["session_id"], "seq": seq}, {"$set": stored}, upsert=True
+            )
+        _cache_put(id, seq, doc)
+        return True
+    except Exception as e:
+        print(f"save_message failed: {e}")
+        return False
+
+# Replies are checkpointed while they stream, so a crash or deploy
+# mid-answer keeps what was generated and a reload shows progress.
+CHECKPOINT_ENABLED = os.getenv("CHECKPOINT_ENABLED", "true").lower() == "true"
+CHECKPOINT_EVERY_TOKENS = int(os.getenv("CHECKPOINT_EVERY_TOKENS", "200"))
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", "1.0"))
+
+class Checkpointer:
+    """
+    Saves one streaming reply at a seq reserved by begin_turn. update() is
+    fed the text so far; once CHECKPOINT_EVERY_TOKENS new tokens or
+    CHECKPOINT_INTERVAL seconds have built up, the latest text is written
+    with status "partial". Only one write is in flight at a time and it
+    always carries the newest text, so bursts collapse into one update.
+    finish() writes the final text with status "complete" (or "partial"
+    if generation was cut short).
+    """
+    def __init__(self, id: str, seq: int, sources=None,
+                 every_tokens=CHECKPOINT_EVERY_TOKENS, interval=CHECKPOINT_INTERVAL):
+        self.id = id
+        self.seq = seq
+        self.sources = sources or []
+        self.every_tokens = every_tokens
+        self.interval = interval
+        self.text = ""
+        self.source_refs = None
+        self.written_tokens = 0
+        self.written_at = time.monotonic()
+        self.pending = None
+        self.checkpoints = 0
+
+    def update(self, text: str):
+        self.text = text
+        if not CHECKPOINT_ENABLED or (self.pending is not None and not self.pending.done()):
+            return
+        tokens = estimate_tokens(text)
+        due = tokens - self.written_tokens >= self.every_tokens or (
+            tokens > self.written_tokens and time.monotonic() - self.written_at >= self.interval
+        )
+        if due:
+            self.pending = asyncio.create_task(self._checkpoint())
+
+    async def _checkpoint(self):
+        try:
+            with span("db.checkpoint"):
+                await self._write("partial")
+        except Exception as e:
+            print(f"Checkpoint failed for {self.id}/{self.seq}: {e}")
+
+    async def _write(self, status: str):
+        text = self.text
+        if self.source_refs is None:
+            self.source_refs = await _store_sources(self.sources)
+        await messages_collection.update_one(
+            {"session_id": ObjectId(self.id), "seq": self.seq},
+            {
+                "$set": {"role": "assistant", "content": text, "status": status, "source_refs": self.source_refs},
+                "$setOnInsert": {"created_at": datetime.utcnow()},
+            },
+            upsert=True,
+        )
+        self.written_tokens = estimate_tokens(text)
+        self.written_at = time.monotonic()
+        self.checkpoints += 1
+        _cache_put(self.id, self.seq, _message_doc(ObjectId(self.id), self.seq, {
+            "role": "assistant", "content": text, "status": status, "sources": self.sources,
+        }))
+
+    async def finish(self, status: str = "complete"):
+        if self.pending is not None:
+            await self.pending
+        if not await sessions_collection.find_one({"_id": ObjectId(self.id)}, projection={"_id": 1}):
+            # Session deleted while the answer streamed: don't write the reply
+            # back as an orphan, and drop a checkpoint that landed after the delete
+            if self.checkpoints:
+                await messages_collection.delete_one({"session_id": ObjectId(self.id), "seq": self.seq})
+            return False
+        if self.checkpoints == 0 and status != "complete" and not self.text:
+            # Cut short before any text: nothing worth keeping, and an empty
+            # partial reply would show up in the history as a blank turn.
+            # Hand the seq back so message_count stays right, unless a later
+            # turn has reserved past it already
+            await sessions_collection.update_one(
+                {"_id": ObjectId(self.id), "message_count": self.seq + 1},
+                {"$inc": {"message_count": -1}},
+            )
+            return False
+        if self.checkpoints == 0 and status == "complete":
+            # Short answer, never checkpointed: one normal write (honours write-behind)
+            return await save_message(self.id, self.seq, {
+                "role": "assistant", "content": self.text, "sources": self.sources, "status": status,
+            })
+        try:
+            with span("db.checkpoint"):
+                await self._write(status)
+            return True
+        except Exception as e:
+            print(f"Final write failed for {self.id}/{self.seq}: {e}")
+            return False
+
+@timed("db.update_session_title")
 async def update_session_title(id: str, title: str):
     try:
         await sessions_collection.update_one(
             {"_id": ObjectId(id)},
             {"$set": {"title": title}}
         )
+        cached = session_cache.get(id)
+        if cached is not None:
+            cached["title"] = title
         return True
     except:
         return False
 
+@timed("db.save_summary")
+async def save_summary(id: str, summary: str, upto: int):
+    """
+    Stores the rolling summary covering messages before seq `upto`.
+    Never moves backwards, so a slow older update can't clobber a newer one.
+    """
+    try:
+        result = await sessions_collection.update_one(
+            {"_id": ObjectId(id), "$or": [{"summary_upto": {"$lt": upto}}, {"summary_upto": {"$exists": False}}]},
+            {"$set": {"summary": summary, "summary_upto": upto}},
+        )
+        cached = session_cache.get(id)
+        if cached is not None and cached.get("summary_upto", 0) < upto:
+            cached["summary"], cached["summary_upto"] = summary, upto
+        return result.modified_count > 0
+    except Exception as e:
+        print(f"save_summary failed: {e}")
+        return False
+
+@timed("db.delete_session")
 async def delete_session(id: str):
+    session_cache.delete(id)
     try:
         result = await sessions_collection.delete_one({"_id": ObjectId(id)})
+        await messages_collection.delete_many({"session_id": ObjectId(id)})
         return result.deleted_count > 0
     except:
         return False
+
+async def _reserve_seq(session_id: ObjectId, count: int = 1, title: str = None):
+    # The filter skips unmigrated sessions so their seq numbers can't collide
+    updates = {"updated_at": datetime.utcnow()}
+    if title is not None:
+        updates["title"] = title
+    return await sessions_collection.find_one_and_update(
+        {"_id": session_id, "messages": {"$exists": False}},
+        {"$inc": {"message_count": count}, "$set": updates},
+        projection={"message_count": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+
+class WriteBehindBuffer:
+    """
+    Collects message writes and sends them as one bulk upsert per batch,
+    flushed every `interval` seconds or as soon as `max_batch` are queued.
+    Trades a short window where a just-finished reply isn't readable yet
+    (and is lost if the process dies) for far fewer round trips under load.
+    """
+    def __init__(self, collection, max_batch=100, interval=0.05):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.interval = interval
+        self.pending = []
+        self.full = asyncio.Event()
+        self.task = None
+        self.flushed = 0
+        self.batches = 0
+
+    async def add(self, doc):
+        self.pending.append(doc)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+
+    async def _run(self):
+        while self.pending:
+            try:
+                await asyncio.wait_for(self.full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        self.full.clear()
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            try:
+                await self.collection.bulk_write([
+                    UpdateOne({"session_id": doc["session_id"], "seq": doc["seq"]}, {"$set": doc}, upsert=True)
+                    for doc in batch
+                ], ordered=False)
+                self.flushed += len(batch)
+                self.batches += 1
+            except Exception as e:
+                print(f"Write-behind flush failed for {len(batch)} messages: {e}")
+
+    async def close(self):
+        await self.flush()
+        if self.task is not None:
+            self.task.cancel()
+
+# Off by default: replies become durable a few ms after the stream ends
+write_behind = None
+if os.getenv("DB_WRITE_BEHIND", "false").lower() == "true":
+    write_behind = WriteBehindBuffer(
+        messages_collection,
+        max_batch=int(os.getenv("DB_WRITE_BEHIND_BATCH", "100")),
+        interval=float(os.getenv("DB_WRITE_BEHIND_INTERVAL", "0.05")),
+    )
+
+async def close_db():
+    if write_behind is not None:
+        await write_behind.close()
+
+async def _migrate_session(session, batch_size=100):
+    """
+    Moves one session's embedded messages into the messages collection.
+    Idempotent: messages are upserted by (session_id, seq) and the embedded
+    array is only removed after they are all written.
+    """
+    messages = session.get("messages") or []
+    ops = [
+        UpdateOne(
+            {"session_id": session["_id"], "seq": seq},
+            {"$setOnInsert": {**message, "session_id": session["_id"], "seq": seq}},
+            upsert=True,
+        )
+        for seq, message in enumerate(messages)
+    ]
+    for i in range(0, len(ops), batch_size):
+        await messages_collection.bulk_write(ops[i:i + batch_size], ordered=False)
+    await sessions_collection.update_one(
+        {"_id": session["_id"], "messages": {"$exists": True}},
+        {"$set": {"message_count": len(messages)}, "$unset": {"messages": ""}},
+    )
+
+async def migrate_embedded_sources(batch_size=100):
+    """Moves sources embedded in stored messages into the sources collection. Returns how many messages."""
+    migrated = 0
+    cursor = messages_collection.find({"sources": {"$exists": True}}, projection={"sources": 1})
+    ops = []
+    async for message in cursor:
+        refs = await _store_sources(message["sources"])
+        ops.append(UpdateOne(
+            {"_id": message["_id"]},
+            {"$set": {"source_refs": refs}, "$unset": {"sources": ""}},
+        ))
+        if len(ops) >= batch_size:
+            await messages_collection.bulk_write(ops, ordered=False)
+            migrated += len(ops)
+            ops = []
+    if ops:
+        await messages_collection.bulk_write(ops, ordered=False)
+        migrated += len(ops)
+    return migrated
+
+async def migrate_embedded_messages():
+    """Migrates every session still using the embedded layout. Returns how many."""
+    migrated = 0
+    cursor = sessions_collection.find({"messages": {"$exists": True}}, projection={"messages": 1})
+    async for session in cursor:
+        await _migrate_session(session)
+        migrated += 1
+    return migrated
+
+if __name__ == "__main__":
+    # python database.py  -> create indexes and migrate embedded messages and sources
+    async def _main():
+        await init_db()
+        count = await migrate_embedded_messages()
+        print(f"Migrated {count} sessions")
+        count = await migrate_embedded_sources()
+        print(f"Moved sources out of {count} messages")
+
+    asyncio.run(_main())
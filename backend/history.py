@@ -0,0 +1,115 @@
+import os
+from context import build_history
+from database import get_session, save_summary
+from services import get_gemini_response
+from metrics import span
+from tasks import spawn
+
+# Follow-ups need the conversation, but sending all of it makes every turn
+# cost more than the last. The last K turns go into the prompt verbatim;
+# older ones are folded into a rolling summary stored on the session, which
+# is updated in the background after each answer so no request waits on it.
+
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() == "true"
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "3"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "200"))
+# Messages folded per model call, so a long legacy session catches up in steps
+SUMMARY_FOLD_BATCH = int(os.getenv("SUMMARY_FOLD_BATCH", "8"))
+
+def _seq(message, index):
+    # Sessions migrated on first touch come back without seq; index matches it
+    return message.get("seq", index)
+
+def split_history(messages, summary_upto=0, keep_turns=HISTORY_KEEP_TURNS):
+    """
+    Splits a session's messages into (to_fold, recent): older messages the
+    summary doesn't cover yet, and the last `keep_turns` user/assistant turns.
+    """
+    keep = max(0, keep_turns) * 2
+    cut = max(0, len(messages) - keep)
+    to_fold = [
+        {**m, "seq": _seq(m, i)}
+        for i, m in enumerate(messages[:cut])
+        if _seq(m, i) >= summary_upto
+    ]
+    return to_fold, messages[cut:]
+
+def history_limit():
+    """How many recent messages history_window needs (None = all of them)."""
+    return max(0, HISTORY_KEEP_TURNS) * 2 if SUMMARY_ENABLED else None
+
+def history_window(session):
+    """
+    The history to send with the next question: the stored summary (as a
+    "summary" message) followed by the recent turns. Messages that aged out
+    of the window but aren't folded yet are left out; the summary catches up
+    right after this turn's answer, so it lags by at most one turn.
+    """
+    # Replies cut short before any text was generated carry nothing to follow up on
+    messages = [
+        m for m in session.get("messages") or []
+        if m.get("content") or m.get("status") != "partial"
+    ]
+    if not SUMMARY_ENABLED:
+        return messages
+    _, recent = split_history(messages, session.get("summary_upto", 0))
+    if session.get("summary"):
+        return [{"role": "summary", "content": session["summary"]}] + recent
+    return recent
+
+async def summarize(previous, messages):
+    """Folds `messages` into the `previous` summary. Returns None on failure."""
+    turns = build_history(messages, budget=SUMMARY_FOLD_BATCH * 400, max_message_tokens=400)
+    prompt = (
+        f"You maintain a running summary of a conversation between a user and a research assistant.\n"
+        f"Current summary:\n{previous or '(empty)'}\n\n"
+        f"New messages:\n{turns}\n\n"
+        f"Rewrite the summary to include the new messages in at most {SUMMARY_MAX_WORDS} words. "
+        f"Keep the topics, named entities, facts and open questions a follow-up might refer to. "
+        f"Reply with the summary only."
+    )
+    summary = (await get_gemini_response(prompt, default="")).strip()
+    return summary or None
+
+async def update_summary(session_id):
+    """Folds every aged-out message into the session's summary. Returns True if it changed."""
+    changed = False
+    while True:
+        session = await get_session(session_id)
+        if not session:
+            return changed
+        to_fold, _ = split_history(session["messages"], session.get("summary_upto", 0))
+        if not to_fold:
+            return changed
+        batch = to_fold[:SUMMARY_FOLD_BATCH]
+        with span("summarize"):
+            summary = await summarize(session.get("summary"), batch)
+        if summary is None:
+            return changed
+        if not await save_summary(session_id, summary, upto=batch[-1]["seq"] + 1):
+            return changed
+        changed = True
+
+_running = {}  # session_id -> rerun requested while running
+
+async def _summary_loop(session_id):
+    try:
+        while True:
+            await update_summary(session_id)
+            if not _running.get(session_id):
+                break
+            _running[session_id] = False
+    except Exception as e:
+        print(f"Summary update failed for {session_id}: {e}")
+    finally:
+        _running.pop(session_id, None)
+
+def schedule_summary(session_id):
+    """Updates the session's summary in the background; one task per session at a time."""
+    if not SUMMARY_ENABLED:
+        return
+    if session_id in _running:
+        _running[session_id] = True
+        return
+    _running[session_id] = False
+    spawn(_summary_loop(session_id))
@@ -0,0 +1,202 @@
+"""
+Concurrent load generator for the chat backend.
+
+Each virtual user creates a session, sends several chat turns, loads the
+history and deletes the session. Latencies are reported per stage and the
+full run can be saved as JSON to compare against a previous run:
+
+    python load_test.py --users 20 --turns 3 --out results.json
+    python load_test.py --users 20 --compare results.json
+
+Pair with stub_server.py (UPSTREAM_STUB_URL) to benchmark without live keys.
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import httpx
+
+QUESTIONS = [
+    "Explain Quantum Physics",
+    "Trends in AI Agents",
+    "Create a workout plan",
+    "Python script for SEO",
+    "What happened in the stock market this week?",
+    "How do vaccines train the immune system?",
+]
+FOLLOW_UPS = [
+    "explain in detail",
+    "give yt tutorials if any",
+    "what are the main criticisms?",
+    "summarize that in three bullet points",
+]
+SPLIT = "\n--split--\n"
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+class Recorder:
+    def __init__(self):
+        self.samples = {
+            "create_session": [], "ttfb": [], "sources": [],
+            "completion": [], "history": [], "delete": [],
+        }
+        self.errors = {}
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def error(self, stage, detail):
+        self.errors.setdefault(stage, []).append(str(detail)[:200])
+
+async def chat_turn(client, rec, session_id, message):
+    start = time.perf_counter()
+    first_byte = sources_at = None
+    buffer = ""
+    async with client.stream("POST", "/api/chat", json={"session_id": session_id, "message": message}) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            rec.error("chat", f"{resp.status_code}: {resp.text}")
+            return False
+        async for chunk in resp.aiter_text():
+            now = time.perf_counter()
+            if first_byte is None:
+                first_byte = now
+            if sources_at is None:
+                buffer += chunk
+                if SPLIT in buffer:
+                    sources_at = now
+                    buffer = ""
+    end = time.perf_counter()
+    if first_byte is not None:
+        rec.add("ttfb", first_byte - start)
+    if sources_at is not None:
+        rec.add("sources", sources_at - start)
+    else:
+        rec.error("chat", "stream ended without a sources chunk")
+    rec.add("completion", end - start)
+    return True
+
+async def user_session(client, rec, turns, think_time):
+    start = time.perf_counter()
+    resp = await client.post("/api/sessions", json={"title": "Load Test"})
+    if resp.status_code != 200:
+        rec.error("create_session", f"{resp.status_code}: {resp.text}")
+        return
+    rec.add("create_session", time.perf_counter() - start)
+    session_id = resp.json()["id"]
+
+    try:
+        messages = [random.choice(QUESTIONS)] + random.sample(FOLLOW_UPS, max(0, min(turns - 1, len(FOLLOW_UPS))))
+        for message in messages[:turns]:
+            if not await chat_turn(client, rec, session_id, message):
+                break
+            if think_time:
+                await asyncio.sleep(random.uniform(0, think_time))
+
+        start = time.perf_counter()
+        resp = await client.get(f"/api/sessions/{session_id}")
+        if resp.status_code == 200:
+            rec.add("history", time.perf_counter() - start)
+        else:
+            rec.error("history", f"{resp.status_code}: {resp.text}")
+    finally:
+        start = time.perf_counter()
+        resp = await client.delete(f"/api/sessions/{session_id}")
+        if resp.status_code == 200:
+            rec.add("delete", time.perf_counter() - start)
+        else:
+            rec.error("delete", f"{resp.status_code}: {resp.text}")
+
+async def run(args):
+    rec = Recorder()
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users)
+    timeout = httpx.Timeout(args.timeout)
+    sem = asyncio.Semaphore(args.users)
+
+    async def one_user():
+        async with sem:
+            try:
+                await user_session(client, rec, args.turns, args.think_time)
+            except Exception as e:
+                rec.error("session", repr(e))
+
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one_user() for _ in range(args.sessions or args.users)))
+        elapsed = time.perf_counter() - started
+
+    turns_done = len(rec.samples["completion"])
+    return {
+        "config": vars(args),
+        "elapsed": elapsed,
+        "throughput": {
+            "chat_turns_per_sec": turns_done / elapsed if elapsed else 0,
+            "sessions_per_sec": len(rec.samples["history"]) / elapsed if elapsed else 0,
+        },
+        "latency": {stage: summarize(values) for stage, values in rec.samples.items()},
+        "errors": {stage: {"count": len(v), "examples": v[:3]} for stage, v in rec.errors.items()},
+    }
+
+def fmt(value):
+    return "-" if value is None else f"{value * 1000:8.0f}ms"
+
+def print_report(report, baseline=None):
+    print(f"\nElapsed {report['elapsed']:.1f}s  "
+          f"chat turns/s {report['throughput']['chat_turns_per_sec']:.2f}  "
+          f"sessions/s {report['throughput']['sessions_per_sec']:.2f}")
+    print(f"{'stage':<15}{'count':>7}{'p50':>11}{'p95':>11}{'p99':>11}")
+    for stage, s in report["latency"].items():
+        line = f"{stage:<15}{s['count']:>7}{fmt(s['p50']):>11}{fmt(s['p95']):>11}{fmt(s['p99']):>11}"
+        if baseline and baseline["latency"].get(stage, {}).get("p95") and s["p95"]:
+            change = (s["p95"] / baseline["latency"][stage]["p95"] - 1) * 100
+            line += f"   p95 {change:+.0f}% vs baseline"
+        print(line)
+    for stage, e in report["errors"].items():
+        print(f"errors[{stage}]: {e['count']}  e.g. {e['examples'][0]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test for /api/chat")
+    parser.add_argument("--url", default="http://localhost:8005")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent sessions")
+    parser.add_argument("--sessions", type=int, help="Total sessions to run (default: --users)")
+    parser.add_argument("--turns", type=int, default=3, help="Chat turns per session")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Max random pause between turns (s)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--out", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Previous JSON report to diff p95s against")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved report to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,40 @@
-from fastapi import FastAPI, HTTPException, Body
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Body, Query, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 from bson import ObjectId
 
-from database import create_session, get_sessions, get_session, add_message, update_session_title, delete_session
-from services import search_web, generate_response_stream, generate_search_query
+from database import session_cache, init_db, close_db, create_session, get_sessions, get_session, get_chat_session, get_messages, begin_turn, Checkpointer, update_session_title, delete_session
+import ratelimit
+import metrics
+from batch import run_batch, parse_items, BATCH_CONCURRENCY
+from admission import admission, lane_for, Overloaded
+from streams import registry as stream_registry, parse_event_id, CHAT_ON_DISCONNECT, CHAT_CANCEL_GRACE, DISCONNECT_POLICIES
+from services import answer_stream, init_http_client, close_http_client, search_cache, answer_cache, model_router, coalescer, ERROR_MARKER
+from history import history_window, history_limit, schedule_summary
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled upstream HTTP client for the whole worker
+    init_http_client()
+    try:
+        await init_db()
+    except Exception as e:
+        print(f"Warning: could not create database indexes: {e}")
+    yield
+    await close_db()
+    await close_http_client()
+
+app = FastAPI(lifespan=lifespan)
+
+# Per-stage timings: Server-Timing header on every response, histograms on /metrics
+app.add_middleware(metrics.ServerTimingMiddleware)
 
 # CORS Setup
 app.add_middleware(
@@ -18,12 +43,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "X-Stream-Id", "Retry-After"],
 )
 
 # Pydantic Models
 class ChatRequest(BaseModel):
     session_id: str
     message: str
+    multi_query: Optional[bool] = None  # None = server default (MULTI_QUERY_ENABLED)
+    # "text" (sources JSON, --split--, raw text) or "sse" (typed, resumable
+    # events). Accept: text/event-stream also selects SSE.
+    stream: Optional[str] = None
+    # "continue" (finish and save the answer if the client leaves) or "cancel"
+    # (stop the upstream calls); None = CHAT_ON_DISCONNECT
+    on_disconnect: Optional[str] = None
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
 class SessionCreate(BaseModel):
     title: str = "New Chat"
@@ -34,16 +69,52 @@ class SessionCreate(BaseModel):
 async def root():
     return {"status": "ok", "service": "Perplexity Cone Backend"}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/api/stats/cache")
+async def cache_stats():
+    return {
+        "search": search_cache.stats(),
+        "answers": answer_cache.stats(),
+        "sessions": session_cache.stats(),
+        "coalescing": coalescer.stats(),
+    }
+
+@app.get("/api/stats/models")
+async def model_stats():
+    return model_router.snapshot()
+
+@app.get("/api/stats/streams")
+async def stream_stats():
+    return stream_registry.stats()
+
+@app.get("/api/stats/admission")
+async def admission_stats():
+    return admission.stats()
+
+@app.get("/api/stats/ratelimits")
+async def ratelimit_stats():
+    return ratelimit.stats()
+
 @app.get("/api/sessions")
-async def list_sessions():
-    return await get_sessions()
+async def list_sessions(response: Response, limit: int = Query(20, ge=1, le=100), cursor: Optional[str] = None):
+    # Body stays a plain list for the sidebar; the next page cursor goes in a header
+    try:
+        sessions, next_cursor = await get_sessions(limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return sessions
 
 @app.post("/api/sessions")
 async def create_new_session(session: SessionCreate):
     data = {
         "title": session.title,
         "created_at": datetime.utcnow(),
-        "messages": []
     }
     return await create_session(data)
 
@@ -54,6 +125,14 @@ async def get_session_history(session_id: str):
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
+@app.get("/api/sessions/{session_id}/messages")
+async def list_session_messages(session_id: str, before: Optional[int] = None, limit: int = Query(50, ge=1, le=200)):
+    result = await get_messages(session_id, before, limit)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    messages, next_before = result
+    return {"messages": messages, "next_before": next_before}
+
 @app.patch("/api/sessions/{session_id}")
 async def update_session_title_endpoint(session_id: str, payload: dict = Body(...)):
     new_title = payload.get("title")
@@ -64,80 +143,177 @@ async def update_session_title_endpoint(session_id: str, payload: dict = Body(..
 
 @app.delete("/api/sessions/{session_id}")
 async def delete_session_endpoint(session_id: str):
+    # Stop answers still streaming into this session first (stream ids are
+    # "<session_id>.<seq>"), so their last write lands before the delete
+    producers = stream_registry.cancel_prefix(f"{session_id}.")
+    if producers:
+        await asyncio.wait(producers, timeout=5)
     success = await delete_session(session_id)
     if not success:
         raise HTTPException(status_code=404, detail="Session not found")
     return {"status": "ok"}
 
+def stage_timings():
+    return {stage: round(seconds * 1000, 1) for stage, seconds in metrics.stage_totals(metrics.request_timings()).items()}
+
+async def answer_events(session_id, reply_seq, user_query, history, multi_query):
+    """
+    One chat turn as typed events: ("sources", results), ("delta", text),
+    ("timings", {stage: ms}), ("error", {...}) and finally ("done", {...}).
+    The reply is checkpointed while it streams and marked complete at the end,
+    or partial if generation failed part way.
+    """
+    full_text = ""
+    failed = False
+    reply = Checkpointer(session_id, reply_seq)
+
+    metrics.INFLIGHT_STREAMS.inc()
+    try:
+        async for kind, data in answer_stream(user_query, history, multi_query):
+            if kind == "sources":
+                reply.sources = data
+                yield "sources", data
+                yield "timings", stage_timings()
+            elif data.lstrip().startswith(ERROR_MARKER):
+                # Not part of the answer: keep it out of the stored text and summary
+                failed = True
+                yield "error", {"message": data.strip()}
+            else:
+                full_text += data
+                reply.update(full_text)
+                yield "delta", data
+
+        # Save Assistant Message to DB
+        status = "partial" if failed else "complete"
+        reply.text = full_text
+        await reply.finish(status)
+        if not failed:
+            schedule_summary(session_id)
+        yield "timings", stage_timings()
+        yield "done", {"seq": reply_seq, "status": status}
+    except asyncio.CancelledError:
+        # Cancelled on disconnect: keep what was generated
+        await reply.finish("partial")
+        raise
+    except Exception as e:
+        print(f"Streaming Error: {e}")
+        await reply.finish("partial")
+        yield "error", {"message": "[System Error: An unexpected error occurred during generation.]"}
+    finally:
+        metrics.INFLIGHT_STREAMS.dec()
+
 @app.post("/api/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, raw_request: Request):
     session_id = request.session_id
     user_query = request.message
+    if request.on_disconnect is not None and request.on_disconnect not in DISCONNECT_POLICIES:
+        raise HTTPException(status_code=422, detail=f"on_disconnect must be one of {', '.join(DISCONNECT_POLICIES)}")
     
-    # Verify session exists
-    session = await get_session(session_id)
+    # Verify session exists; only the summary and the last few turns are loaded
+    session = await get_chat_session(session_id, history_limit())
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+
+    # Wait for a generation slot before writing anything; overflow gets a fast 429
+    try:
+        await admission.acquire(lane_for(user_query, session['message_count'] > 0))
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    admitted_at = time.monotonic()
     
-    # 1. Save User Message
+    # 1. Save User Message (and set the title on the first message) in one
+    # session update; the reply's seq is reserved at the same time
     user_msg = {"role": "user", "content": user_query}
-    await add_message(session_id, user_msg)
-    
-    # 2. Contextualize Search Query
-    # Use the session messages (which represents history BEFORE this new message if fetched early, 
-    # but we just added a message? No, 'session' var is stale, which is good for history)
-    refined_query = generate_search_query(session['messages'], user_query)
-    print(f"Refined Query: {refined_query}")
-    
-    # 3. Search Web with Refined Query
-    search_results = search_web(refined_query)
-    
-    # 3. Update Title if it's the first message
-    if len(session['messages']) == 0:
-        new_title = " ".join(user_query.split()[:5])
-        await update_session_title(session_id, new_title)
+    new_title = " ".join(user_query.split()[:5]) if session['message_count'] == 0 else None
+    reply_seq = await begin_turn(session_id, user_msg, title=new_title)
+    if reply_seq is None:
+        admission.release()
+        raise HTTPException(status_code=404, detail="Session not found")
 
-    # 4. Generator function for Streaming Response
-    async def response_generator():
-        full_text = ""
-        # Send search results first as a special event or just part of the stream?
-        # For simplicity, we'll just stream the text. 
-        # But we need to save the final answer to DB.
-        
-        # We can send a JSON header with sources first?
-        # To keep it simple, we will stream the text, and the frontend will handle sources if we return them separately?
-        # StreamingResponse expects bytes or strings.
-        
-        # Let's send sources as a JSON line first, then the text?
-        # Or standard Server Sent Events (SSE). 
-        # For this "simple" migration, let's just stream text. 
-        # BUT we need to send sources to the frontend.
-        # Strategy: Send a JSON object with sources as the first chunk?
-        # Or use a special separator.
-        
-        # Let's format the first chunk as JSON containing sources.
-        import json
-        sources_data = json.dumps({"type": "sources", "data": search_results}) + "\n--split--\n"
-        yield sources_data
-        
+    # 2. Rewrite, search and generation run inside answer_stream, so identical
+    # first-turn questions arriving together share one upstream run.
+    # 'session' is stale (fetched before the user message was added), which is
+    # exactly the history we want: its summary plus the last few turns.
+    history = history_window(session)
+
+    # 3. Generation runs as a background task publishing into a replay
+    # buffer, not inside the response, so it outlives a dropped client
+    # (on_disconnect="continue") or is cancelled with it ("cancel").
+    async def produce(stream):
         try:
-            # Stream Gemini content
-            async for chunk in generate_response_stream(user_query, search_results, session['messages']):
-                full_text += chunk
-                yield chunk
-
-            # Save Assistant Message to DB
-            assistant_msg = {
-                "role": "assistant",
-                "content": full_text,
-                "sources": search_results
-            }
-            await add_message(session_id, assistant_msg)
-        except Exception as e:
-            print(f"Streaming Error: {e}")
-            yield f"\n\n[System Error: An unexpected error occurred during generation.]"
-
-    return StreamingResponse(response_generator(), media_type="text/plain")
+            async for kind, data in answer_events(session_id, reply_seq, user_query, history, request.multi_query):
+                await stream.publish(kind, data)
+        finally:
+            await stream.close()
+
+    stream = stream_registry.create(
+        f"{session_id}.{reply_seq}", produce, on_disconnect=request.on_disconnect or CHAT_ON_DISCONNECT
+    )
+    # Done callback rather than a finally in produce: it also runs if the task is cancelled before it starts
+    stream.task.add_done_callback(lambda _: admission.release(time.monotonic() - admitted_at))
+
+    sse = request.stream == "sse" or (
+        request.stream is None and "text/event-stream" in raw_request.headers.get("accept", "")
+    )
+    if sse:
+        # A dropped client can resume from the replay buffer via /api/chat/streams/{id}
+        body = stream_registry.follow(stream, stream.sse(), grace=CHAT_CANCEL_GRACE)
+        headers = {**SSE_HEADERS, "X-Stream-Id": stream.id}
+        return StreamingResponse(body, media_type="text/event-stream", headers=headers)
+
+    # Plain text: first chunk is JSON containing sources, then a separator, then text
+    async def response_generator():
+        async for _, kind, data in stream.subscribe():
+            if kind == "sources":
+                yield json.dumps({"type": "sources", "data": data}) + "\n--split--\n"
+            elif kind == "delta":
+                yield data
+            elif kind == "error":
+                yield f"\n\n{data['message']}"
+
+    body = stream_registry.follow(stream, response_generator())
+    return StreamingResponse(body, media_type="text/plain", headers={"X-Stream-Id": stream.id})
+
+@app.post("/api/batch")
+async def batch_endpoint(
+    raw_request: Request,
+    concurrency: int = Query(BATCH_CONCURRENCY, ge=1),
+    persist: bool = Query(False, description="Save each answer as a chat session"),
+):
+    """JSONL questions in, NDJSON results out as each one finishes (see batch.py)."""
+    body = (await raw_request.body()).decode()
+    items = list(parse_items(body.splitlines()))
+
+    async def results():
+        async for result in run_batch(items, concurrency, persist):
+            yield json.dumps(result, default=str) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.get("/api/chat/streams/{stream_id}")
+async def resume_stream(
+    stream_id: str,
+    last_event_id: Optional[str] = Header(None),
+    after: Optional[int] = Query(None, description="Resume after this event number (for clients that can't set Last-Event-ID)"),
+):
+    """Replays an SSE answer after the client's last event, then follows it live."""
+    stream = stream_registry.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired; the answer may already be saved")
+    position = -1
+    if last_event_id:
+        event_stream_id, n = parse_event_id(last_event_id)
+        if event_stream_id != stream_id:
+            raise HTTPException(status_code=400, detail="Last-Event-ID belongs to a different stream")
+        position = n
+    elif after is not None:
+        position = after
+    if not stream.can_resume(position):
+        raise HTTPException(status_code=410, detail="Those events are no longer buffered; reload the session instead")
+    if position >= 0:
+        stream_registry.resumed += 1
+    body = stream_registry.follow(stream, stream.sse(position), grace=CHAT_CANCEL_GRACE)
+    return StreamingResponse(body, media_type="text/event-stream", headers=SSE_HEADERS)
 
 if __name__ == "__main__":
     print("DEBUG: Entered __main__")
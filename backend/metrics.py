@@ -0,0 +1,140 @@
+import time
+import functools
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Prometheus metrics plus per-request stage timings for the Server-Timing header.
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_duration_seconds", "Time spent in each pipeline stage",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60),
+)
+STAGE_ERRORS = Counter("chat_stage_errors_total", "Stages that raised", ["stage"])
+MODEL_ATTEMPTS = Counter("model_attempts_total", "Generation attempts per model and outcome", ["model", "outcome"])
+MODEL_TTFT = Histogram(
+    "model_time_to_first_chunk_seconds", "Time to first streamed chunk per model", ["model"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 30),
+)
+MODEL_FALLBACKS = Counter("model_fallbacks_total", "Times a model failed and the next one was tried", ["model"])
+MODEL_HEDGES = Counter("model_hedges_total", "Times a model was hedged with the next one", ["model"])
+INFLIGHT_STREAMS = Gauge("chat_inflight_streams", "Chat responses currently streaming")
+ADMISSION_INFLIGHT = Gauge("admission_inflight_generations", "Generations holding an admission slot")
+ADMISSION_QUEUED = Gauge("admission_queued_requests", "Chat requests waiting for a slot", ["lane"])
+ADMISSION_WAIT = Histogram(
+    "admission_wait_seconds", "Time chat requests waited for a slot", ["lane"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20),
+)
+ADMISSION_REJECTED = Counter("admission_rejected_total", "Chat requests turned away with 429", ["reason"])
+CACHE_HIT_RATIO = Gauge("cache_hit_ratio", "Hit ratio since start", ["cache"])
+CACHE_ENTRIES = Gauge("cache_entries", "Entries currently cached", ["cache"])
+
+# Stage timings for the current request, read by ServerTimingMiddleware
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def _record(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def span(stage):
+    """Times a block into the stage histogram and the request's Server-Timing."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        _record(stage, time.perf_counter() - start)
+
+def timed(stage):
+    """Decorator form of span() for async functions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def request_timings():
+    return _request_timings.get() or []
+
+@contextmanager
+def timings_scope():
+    """Collects stage timings for work outside an HTTP request (e.g. one batch item)."""
+    timings = []
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+def observe_model(event, model, seconds=None):
+    """Router callback: event is ok / error / cancelled / fallback / hedge / ttft."""
+    if event == "ttft":
+        MODEL_TTFT.labels(model).observe(seconds)
+    elif event == "fallback":
+        MODEL_FALLBACKS.labels(model).inc()
+    elif event == "hedge":
+        MODEL_HEDGES.labels(model).inc()
+    else:
+        MODEL_ATTEMPTS.labels(model, event).inc()
+        if seconds is not None:
+            _record(f"model.{model}", seconds)
+
+def register_cache(name, cache):
+    """Exports a cache's stats() hit ratio and size, read at scrape time."""
+    CACHE_HIT_RATIO.labels(name).set_function(lambda: cache.stats()["hit_ratio"])
+    CACHE_ENTRIES.labels(name).set_function(lambda: cache.stats()["size"])
+
+def stage_totals(timings):
+    # Repeated stages (e.g. two db.add_message calls) are summed
+    totals = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return totals
+
+def server_timing_header(timings):
+    return ", ".join(
+        f"{stage.replace('.', '-').replace(':', '-')};dur={seconds * 1000:.1f}"
+        for stage, seconds in stage_totals(timings).items()
+    )
+
+class ServerTimingMiddleware:
+    """
+    Pure ASGI middleware: gives each HTTP request its own timing list and
+    adds a Server-Timing header from it when the response starts. Streaming
+    responses start before generation, so for /api/chat the header covers
+    the stages up to the first byte; later stages still reach /metrics.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = []
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                entries = list(timings) + [("total", time.perf_counter() - start)]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing_header(entries).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+
+def render():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,184 @@
+import os
+import re
+import time
+import asyncio
+import threading
+
+# Process-wide token buckets, one per upstream (a Gemini model, Tavily).
+# No other backend imports: the Streamlit app.py shares these limiters.
+
+class RateLimiter:
+    """
+    Token bucket that hands out reservations in arrival order.
+
+    Each caller takes a token immediately (the balance may go negative) and
+    waits until the bucket would have refilled to cover it, so waiters are
+    served first-come-first-served without a separate queue. penalize()
+    pushes every reservation past a server-supplied Retry-After.
+    State is guarded by a thread lock and uses no loop-bound primitives, so
+    the same limiter works from async handlers and from sync threads.
+    """
+    def __init__(self, name, rate_per_minute, burst=None):
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst if burst is not None else max(1, rate_per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.granted = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.penalty = 0.0  # seconds penalize() has added to the block, in total
+
+    def _refill(self, now):
+        # While blocked by penalize(), `updated` sits in the future and nothing accrues
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def _wait_for(self, tokens, now):
+        return max(0.0, self.updated - now) + max(0.0, -tokens) / self.rate
+
+    def predict_wait(self):
+        """Seconds a caller arriving now would wait, without reserving."""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._wait_for(self.tokens - 1, now)
+
+    def reserve(self):
+        """Takes a token and returns how many seconds to wait before using it."""
+        return self._reserve()[0]
+
+    def _reserve(self):
+        # Also returns the penalty total at reservation time (see _penalty_since)
+        if self.rate <= 0:
+            return 0.0, 0.0
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = self._wait_for(self.tokens, now)
+            self.granted += 1
+            if wait > 0:
+                self.throttled += 1
+                self.total_wait += wait
+            return wait, self.penalty
+
+    def refund(self):
+        """Gives back a reserved token that was never used."""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+            self.granted -= 1
+
+    def _penalty_since(self, mark):
+        # A Retry-After that arrived while a reservation was sleeping pushes
+        # it back by as much as the block grew, keeping queued callers in
+        # order and spaced at the normal rate once the block lifts
+        with self.lock:
+            return self.penalty - mark
+
+    def _track_waiting(self, delta):
+        with self.lock:
+            self.waiting += delta
+
+    async def acquire(self):
+        wait, mark = self._reserve()
+        if wait > 0:
+            self._track_waiting(1)
+            try:
+                await asyncio.sleep(wait)
+                while (extra := self._penalty_since(mark)) > 0:
+                    mark += extra
+                    await asyncio.sleep(extra)
+            except asyncio.CancelledError:
+                # Caller gave up while queued; don't charge the bucket for it
+                self.refund()
+                raise
+            finally:
+                self._track_waiting(-1)
+        return wait
+
+    def acquire_sync(self):
+        wait, mark = self._reserve()
+        if wait > 0:
+            self._track_waiting(1)
+            try:
+                time.sleep(wait)
+                while (extra := self._penalty_since(mark)) > 0:
+                    mark += extra
+                    time.sleep(extra)
+            finally:
+                self._track_waiting(-1)
+        return wait
+
+    def penalize(self, seconds):
+        """Honors an upstream Retry-After: nothing is granted before it expires."""
+        if not seconds or seconds <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            blocked_until = now + seconds
+            self.penalty += max(0.0, blocked_until - max(self.updated, now))
+            # Refill restarts when the block lifts, so queued callers are still
+            # spaced out at the normal rate instead of all firing at once
+            self.updated = max(self.updated, blocked_until)
+            self.tokens = min(self.tokens, 0.0)
+
+    def stats(self):
+        return {
+            "rate_per_minute": self.rate * 60,
+            "capacity": self.capacity,
+            "tokens": round(self.tokens, 2),
+            "queue_depth": self.waiting,
+            "blocked_for": max(0.0, self.updated - time.monotonic()),
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "avg_wait": self.total_wait / self.throttled if self.throttled else 0.0,
+        }
+
+# Per-upstream limits (requests per minute); 0 disables limiting.
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+TAVILY_RPM = float(os.getenv("TAVILY_RPM", "100"))
+
+limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(key, rate_per_minute=None):
+    """
+    Returns the shared limiter for e.g. "gemini:gemini-2.5-flash" or "tavily".
+    rate_per_minute only applies when the limiter is first created.
+    """
+    with _limiters_lock:
+        limiter = limiters.get(key)
+        if limiter is None:
+            if rate_per_minute is None:
+                rate_per_minute = TAVILY_RPM if key == "tavily" else GEMINI_RPM
+            limiter = limiters[key] = RateLimiter(key, rate_per_minute)
+        return limiter
+
+def parse_retry_after(headers=None, body=""):
+    """
+    Seconds to back off after a 429: the Retry-After header if present,
+    else Gemini's RetryInfo "retryDelay": "23s" (or SDK "retry_delay { seconds: 23 }").
+    """
+    value = headers.get("retry-after") if headers else None
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    match = re.search(r'retryDelay"?\s*:\s*"?(\d+(?:\.\d+)?)s', body or "") \
+        or re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)', body or "")
+    if match:
+        return float(match.group(1))
+    return None
+
+def stats():
+    return {key: limiter.stats() for key, limiter in limiters.items()}
@@ -0,0 +1,54 @@
+import re
+from collections import Counter
+import numpy as np
+
+# Local BM25 passage scoring, plugged into context.build_context as score_fn.
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+class BM25Index:
+    """
+    BM25 over a fixed set of passages.
+    Stores sparse postings (term -> passage ids and term counts), so memory
+    grows with the text, not passages x vocabulary, and scoring a query
+    only computes weights for the query's own terms.
+    """
+    def __init__(self, passages, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.n_docs = len(passages)
+        postings = {}
+        doc_len = np.zeros(self.n_docs, dtype=np.float32)
+        for i, passage in enumerate(passages):
+            counts = Counter(tokenize(passage))
+            doc_len[i] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(i)
+                postings[term][1].append(tf)
+        self.postings = {
+            term: (np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.float32))
+            for term, (ids, tfs) in postings.items()
+        }
+        avg_len = doc_len.mean() if self.n_docs and doc_len.mean() > 0 else 1.0
+        self.norm = k1 * (1.0 - b + b * doc_len / avg_len)
+
+    def score(self, query):
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        # Repeated query terms count once per occurrence, as in standard BM25
+        for term in tokenize(query):
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            ids, tf = entry
+            idf = np.log(1.0 + (self.n_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * tf * (self.k1 + 1.0) / (tf + self.norm[ids])
+        return scores
+
+def bm25_score(query, passages):
+    """score_fn for build_context: BM25 score of each passage against the query."""
+    if not passages:
+        return []
+    return BM25Index(passages).score(query).tolist()
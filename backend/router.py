@@ -0,0 +1,233 @@
+import time
+import asyncio
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class AllModelsFailed(Exception):
+    pass
+
+class ModelStats:
+    """Rolling health for one model: latency/error EWMAs plus a circuit breaker."""
+    def __init__(self, name, alpha=0.2, window=100):
+        self.name = name
+        self.alpha = alpha
+        self.ttft_ewma = None       # seconds to first chunk
+        self.error_ewma = 0.0
+        self.ttft_samples = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+        self.fallbacks = 0
+        self.hedges = 0
+
+    def record_ttft(self, seconds):
+        self.ttft_samples.append(seconds)
+        if self.ttft_ewma is None:
+            self.ttft_ewma = seconds
+        else:
+            self.ttft_ewma = self.alpha * seconds + (1 - self.alpha) * self.ttft_ewma
+
+    def record_success(self):
+        self.error_ewma = (1 - self.alpha) * self.error_ewma
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.trial_in_flight = False
+
+    def record_failure(self, failure_threshold):
+        self.failures += 1
+        self.error_ewma = self.alpha + (1 - self.alpha) * self.error_ewma
+        self.consecutive_failures += 1
+        self.trial_in_flight = False
+        if self.state == HALF_OPEN or self.consecutive_failures >= failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def percentile(self, p):
+        if not self.ttft_samples:
+            return None
+        ordered = sorted(self.ttft_samples)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "ttft_ewma": self.ttft_ewma,
+            "ttft_p50": self.percentile(0.5),
+            "ttft_p90": self.percentile(0.9),
+            "error_rate": self.error_ewma,
+            "consecutive_failures": self.consecutive_failures,
+            "requests": self.requests,
+            "failures": self.failures,
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+        }
+
+class ModelRouter:
+    """
+    Picks which model serves a streamed answer.
+
+    Models are tried in priority order, skipping any whose breaker is open
+    (it opens after `failure_threshold` consecutive failures and lets one
+    trial through after `cooldown` seconds) or whose error rate is above
+    `max_error_rate`. With hedging on, if the current model hasn't produced
+    its first chunk by its `hedge_percentile` time-to-first-token, the next
+    model is started too and whichever speaks first wins.
+    """
+    def __init__(self, models, stream_fn, failure_threshold=3, cooldown=30.0,
+                 max_error_rate=0.5, hedge=False, hedge_percentile=0.9,
+                 min_hedge_delay=1.0, default_hedge_delay=4.0, observer=None):
+        self.models = list(models)
+        self.stream_fn = stream_fn
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_error_rate = max_error_rate
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.stats = {m: ModelStats(m) for m in self.models}
+        # observer(event, model, seconds=None) gets ok/error/cancelled/fallback/hedge/ttft events
+        self.observer = observer or (lambda event, model, seconds=None: None)
+
+    def _available(self, stats):
+        if stats.state == OPEN:
+            if time.monotonic() - stats.opened_at < self.cooldown:
+                return False
+            stats.state = HALF_OPEN
+        if stats.state == HALF_OPEN:
+            # Only one trial request at a time while half-open
+            return not stats.trial_in_flight
+        return True
+
+    def order(self):
+        healthy, degraded, blocked = [], [], []
+        for m in self.models:
+            stats = self.stats[m]
+            if not self._available(stats):
+                blocked.append(m)
+            elif stats.error_ewma > self.max_error_rate:
+                degraded.append(m)
+            else:
+                healthy.append(m)
+        # If every breaker is open, still try something rather than failing outright
+        return healthy + degraded or blocked
+
+    def hedge_delay(self, model):
+        delay = self.stats[model].percentile(self.hedge_percentile)
+        if delay is None:
+            delay = self.default_hedge_delay
+        return max(self.min_hedge_delay, delay)
+
+    def _launch(self, model, prompt):
+        stats = self.stats[model]
+        stats.requests += 1
+        if stats.state == HALF_OPEN:
+            stats.trial_in_flight = True
+        agen = self.stream_fn(model, prompt)
+        task = asyncio.ensure_future(agen.__anext__())
+        return {"model": model, "agen": agen, "task": task, "started": time.monotonic()}
+
+    async def _discard(self, attempt):
+        attempt["task"].cancel()
+        await asyncio.gather(attempt["task"], return_exceptions=True)
+        try:
+            await attempt["agen"].aclose()
+        except Exception:
+            pass
+        stats = self.stats[attempt["model"]]
+        stats.trial_in_flight = False
+        self.observer("cancelled", attempt["model"], time.monotonic() - attempt["started"])
+
+    async def stream(self, prompt):
+        """
+        Yields (model_name, text) chunks from whichever model wins.
+        Raises AllModelsFailed if no model produced a first chunk.
+        Errors after the first chunk are recorded and re-raised.
+        """
+        candidates = self.order()
+        next_idx = 0
+        attempts = []
+        hedged = False
+        last_error = None
+        winner, first = None, None
+
+        attempts.append(self._launch(candidates[next_idx], prompt))
+        next_idx += 1
+        try:
+            while attempts:
+                timeout = None
+                if self.hedge and not hedged and next_idx < len(candidates) and len(attempts) == 1:
+                    elapsed = time.monotonic() - attempts[0]["started"]
+                    timeout = max(0.0, self.hedge_delay(attempts[0]["model"]) - elapsed)
+
+                done, _ = await asyncio.wait([a["task"] for a in attempts], timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.stats[attempts[0]["model"]].hedges += 1
+                    self.observer("hedge", attempts[0]["model"])
+                    print(f"Hedging {attempts[0]['model']} with {candidates[next_idx]}")
+                    attempts.append(self._launch(candidates[next_idx], prompt))
+                    next_idx += 1
+                    continue
+
+                for attempt in [a for a in attempts if a["task"] in done]:
+                    attempts.remove(attempt)
+                    try:
+                        first = attempt["task"].result()
+                    except StopAsyncIteration:
+                        first = ""
+                    except Exception as e:
+                        print(f"Model {attempt['model']} failed: {e}")
+                        last_error = e
+                        self.stats[attempt["model"]].record_failure(self.failure_threshold)
+                        self.observer("error", attempt["model"], time.monotonic() - attempt["started"])
+                        continue
+                    winner = attempt
+                    break
+
+                if winner:
+                    break
+                if not attempts and next_idx < len(candidates):
+                    self.stats[candidates[next_idx - 1]].fallbacks += 1
+                    self.observer("fallback", candidates[next_idx - 1])
+                    print(f"Switching to Fallback: {candidates[next_idx]}")
+                    attempts.append(self._launch(candidates[next_idx], prompt))
+                    next_idx += 1
+        finally:
+            for attempt in attempts:
+                await self._discard(attempt)
+
+        if winner is None:
+            raise AllModelsFailed(str(last_error))
+
+        model = winner["model"]
+        stats = self.stats[model]
+        stats.record_ttft(time.monotonic() - winner["started"])
+        self.observer("ttft", model, time.monotonic() - winner["started"])
+        completed = False
+        try:
+            if first:
+                yield model, first
+            async for text in winner["agen"]:
+                yield model, text
+            completed = True
+        except Exception:
+            stats.record_failure(self.failure_threshold)
+            self.observer("error", model, time.monotonic() - winner["started"])
+            raise
+        finally:
+            if not completed:
+                stats.trial_in_flight = False
+                await winner["agen"].aclose()
+        stats.record_success()
+        self.observer("ok", model, time.monotonic() - winner["started"])
+
+    def snapshot(self):
+        return {m: self.stats[m].snapshot() for m in self.models}
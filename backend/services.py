@@ -5,7 +5,14 @@ import random
 import httpx
 import json
 import asyncio
-from tavily import TavilyClient
+from urllib.parse import urlsplit
+from cache import TTLCache, AnswerCache
+from router import ModelRouter, AllModelsFailed
+from context import build_context, build_history
+from rerank import bm25_score
+from ratelimit import get_limiter, parse_retry_after
+from coalesce import Coalescer
+from metrics import span, observe_model, register_cache
 
 # API Keys
 # API Keys
@@ -15,93 +22,186 @@ load_dotenv()
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# Upstream endpoints. UPSTREAM_STUB_URL points both at the local stand-in
+# server (stub_server.py) for offline benchmarks and tests.
+UPSTREAM_STUB_URL = os.getenv("UPSTREAM_STUB_URL")
+GEMINI_API_BASE = UPSTREAM_STUB_URL or os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com")
+TAVILY_API_BASE = UPSTREAM_STUB_URL or os.getenv("TAVILY_API_BASE", "https://api.tavily.com")
+if UPSTREAM_STUB_URL:
+    print(f"Using stub upstreams at {UPSTREAM_STUB_URL}")
+    TAVILY_API_KEY = TAVILY_API_KEY or "stub"
+    GEMINI_API_KEY = GEMINI_API_KEY or "stub"
+
 if not TAVILY_API_KEY or not GEMINI_API_KEY:
     print("Warning: API Keys not found in environment variables")
 
-# Initialize Tavily
-try:
-    tavily = TavilyClient(api_key=TAVILY_API_KEY)
-except Exception as e:
-    print(f"Error initializing Tavily: {e}")
+# Shared HTTP client
+# One pooled client per process so upstream calls reuse DNS/TCP/TLS setup.
+# Created and closed by the FastAPI lifespan in main.py; scripts that import
+# services directly get one lazily on first use.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+
+http_client = None
+http_client_sync = None
+
+def _client_options():
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    http2 = HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("Warning: h2 not installed, falling back to HTTP/1.1")
+            http2 = False
+    return {"limits": limits, "http2": http2, "timeout": httpx.Timeout(30.0, connect=60.0)}
+
+def init_http_client():
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(**_client_options())
+    return http_client
+
+async def close_http_client():
+    global http_client, http_client_sync
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    if http_client_sync is not None:
+        http_client_sync.close()
+        http_client_sync = None
+
+def get_http_client():
+    if http_client is None or http_client.is_closed:
+        return init_http_client()
+    return http_client
+
+def get_http_client_sync():
+    global http_client_sync
+    if http_client_sync is None or http_client_sync.is_closed:
+        http_client_sync = httpx.Client(**_client_options())
+    return http_client_sync
 
 # Direct REST API Helper
+def _extract_text(result):
+    """Pulls the text parts out of one generateContent response object."""
+    candidates = result.get('candidates')
+    if candidates is None:
+        raise Exception(f"Malformed response: {result}")
+    if not candidates:
+        # Blocked output?
+        return "I cannot answer this question due to safety filters."
+    parts = candidates[0].get('content', {}).get('parts', [])
+    return "".join(p.get('text', '') for p in parts)
+
+class StreamParser:
+    """
+    Incremental parser for streamGenerateContent bodies.
+    Handles both wire formats Google sends back:
+      - SSE (?alt=sse): 'data: {...}' lines separated by blank lines
+      - plain REST: one JSON array '[{...},\n{...}]' written element by element
+    Feed it raw text chunks; it returns every complete JSON object seen so far.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        objects = []
+        while True:
+            # Skip array punctuation and whitespace between elements
+            stripped = self.buffer.lstrip(" \t\r\n[,]")
+            if stripped.startswith("data:"):
+                line_end = stripped.find("\n")
+                if line_end == -1:
+                    self.buffer = stripped
+                    break
+                payload = stripped[5:line_end].strip()
+                self.buffer = stripped[line_end + 1:]
+                if payload and payload != "[DONE]":
+                    objects.append(json.loads(payload))
+                continue
+            if not stripped:
+                self.buffer = ""
+                break
+            if not stripped.startswith("{"):
+                # Other SSE fields (event:, id:, comments) carry nothing we need
+                line_end = stripped.find("\n")
+                if line_end == -1:
+                    self.buffer = stripped
+                    break
+                self.buffer = stripped[line_end + 1:]
+                continue
+            try:
+                obj, end = self.decoder.raw_decode(stripped)
+            except json.JSONDecodeError:
+                # Object not complete yet, wait for more bytes
+                self.buffer = stripped
+                break
+            objects.append(obj)
+            self.buffer = stripped[end:]
+        return objects
+
+async def stream_gemini_rest(model_name, prompt):
+    """
+    Streams a response from streamGenerateContent, yielding text parts as they arrive.
+    alt=sse makes Google frame each candidate chunk as its own SSE event.
+    """
+    url = f"{GEMINI_API_BASE}/v1beta/models/{model_name}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+    headers = {"Content-Type": "application/json"}
+    data = {"contents": [{"parts": [{"text": prompt}]}]}
+
+    limiter = get_limiter(f"gemini:{model_name}")
+    await limiter.acquire()
+    client = get_http_client()
+    async with client.stream("POST", url, headers=headers, json=data) as response:
+        if response.status_code != 200:
+            error_text = (await response.aread()).decode('utf-8')
+            if response.status_code == 429:
+                limiter.penalize(parse_retry_after(response.headers, error_text))
+            raise Exception(f"API Error {response.status_code}: {error_text}")
+
+        parser = StreamParser()
+        async for chunk in response.aiter_text():
+            for result in parser.feed(chunk):
+                if 'error' in result:
+                    raise Exception(f"API Error in stream: {result['error']}")
+                # Trailing chunks may only carry usageMetadata
+                if 'candidates' not in result:
+                    continue
+                text = _extract_text(result)
+                if text:
+                    yield text
+
 async def run_gemini_rest(model_name, prompt, stream=False, is_fallback=False):
     """
     Executes a direct REST API call to Google Generative AI.
     Bypasses the Python SDK to avoid versioning/alias issues.
+    With stream=True returns an async generator (see stream_gemini_rest).
     """
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:{'streamGenerateContent' if stream else 'generateContent'}?key={GEMINI_API_KEY}"
+    if stream:
+        return stream_gemini_rest(model_name, prompt)
+
+    url = f"{GEMINI_API_BASE}/v1beta/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
     headers = {"Content-Type": "application/json"}
     data = {"contents": [{"parts": [{"text": prompt}]}]}
     
-    timeout = httpx.Timeout(30.0, connect=60.0)
+    limiter = get_limiter(f"gemini:{model_name}")
+    await limiter.acquire()
+    response = await get_http_client().post(url, headers=headers, json=data)
+    if response.status_code != 200:
+        if response.status_code == 429:
+            limiter.penalize(parse_retry_after(response.headers, response.text))
+        raise Exception(f"API Error {response.status_code}: {response.text}")
     
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        if stream:
-            async with client.stream("POST", url, headers=headers, json=data) as response:
-                if response.status_code != 200:
-                    error_text = await response.aread()
-                    raise Exception(f"API Error {response.status_code}: {error_text.decode('utf-8')}")
-                
-                # buffer = ""
-                async for chunk in response.aiter_lines():
-                    if chunk.startswith("data:"):
-                        json_str = chunk[5:].strip()
-                        if not json_str: continue
-                        try:
-                            # Gemini stream returns a list (JSON array) or just an object?
-                            # Usually streamGenerateContent returns JSON objects.
-                            # But raw REST streaming often sends 'data: ' lines with JSON.
-                            # Let's handle standard JSON parsing.
-                            pass
-                        except:
-                            pass
-                
-                # Start simple: The REST stream format is complex to parse manually (it's a JSON array being built).
-                # simpler approach: use non-streaming fallback for now if stream is too hard?
-                # Actually, streamGenerateContent via REST returns a JSON array, typically chunked.
-                # BUT parsing partial JSON is hard.
-                # Strategy: We will read chunks as raw bytes and try to extract 'text' fields using regex or partial json parsing?
-                # "data" usually contains a complete candidates object.
-                
-                # Let's rely on line-based parsing if possible, or just accumulate text.
-                # Actually, Google's REST stream yields JSON objects not SSE format usually?
-                # It returns a JSON array [ ... , ... ]
-                
-                # To be safe and fast given the user's frustration:
-                # We will use NON-STREAMING for stability if streaming is tricky via REST in 5 mins.
-                # User wants reliability.
-                # However, the frontend functionality depends on streaming visually?
-                # Let's implement a pseudo-stream or try to do it right.
-                
-                # Simple Hack: Use a synchronous generator that yields the full text char by char? 
-                # No, that's fake.
-                
-                # Correct way: standard HTTP streaming. httpx .stream() yields bytes.
-                # We interpret the bytes.
-                pass
-
-        else:
-            response = await client.post(url, headers=headers, json=data)
-            if response.status_code != 200:
-                raise Exception(f"API Error {response.status_code}: {response.text}")
-            
-            result = response.json()
-            try:
-                return result['candidates'][0]['content']['parts'][0]['text']
-            except (KeyError, IndexError) as e:
-                 # Safety check
-                 if 'candidates' in result and not result['candidates']:
-                     # Blocked output?
-                     return "I cannot answer this question due to safety filters."
-                 raise Exception(f"Malformed response: {result}")
-
-# Since streaming raw JSON array is complex, we will implement a helper
-# that parses the JSON array incrementally if possible, OR
-# fallback to non-streaming if urgency dictates.
-# Given the user's state ("give up"), reliability > streaming.
-# I will DISABLE streaming for the direct API implementation to ensure 100% success.
-# The frontend will just wait a few seconds and then show the text.
+    return _extract_text(response.json())
 
 def get_gemini_response_sync(prompt):
     # Wrapper for sync usage in generate_search_query
@@ -109,19 +209,49 @@ def get_gemini_response_sync(prompt):
     # services.py is imported.
     # We can use httpx.Client (sync)
     model_name = "gemini-2.0-flash-exp"
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
+    url = f"{GEMINI_API_BASE}/v1beta/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
     headers = {"Content-Type": "application/json"}
     data = {"contents": [{"parts": [{"text": prompt}]}]}
     
-    with httpx.Client() as client:
-        resp = client.post(url, headers=headers, json=data)
-        if resp.status_code != 200:
-            return prompt # Fail safe
-        
-        try:
-            return resp.json()['candidates'][0]['content']['parts'][0]['text']
-        except:
-            return prompt
+    limiter = get_limiter(f"gemini:{model_name}")
+    limiter.acquire_sync()
+    resp = get_http_client_sync().post(url, headers=headers, json=data)
+    if resp.status_code != 200:
+        if resp.status_code == 429:
+            limiter.penalize(parse_retry_after(resp.headers, resp.text))
+        return prompt # Fail safe
+    
+    try:
+        return resp.json()['candidates'][0]['content']['parts'][0]['text']
+    except:
+        return prompt
+
+async def get_gemini_response(prompt, default=None):
+    # Async twin of get_gemini_response_sync, on the shared pooled client.
+    # On failure returns `default`, or the prompt itself if none is given.
+    if default is None:
+        default = prompt
+    model_name = "gemini-2.0-flash-exp"
+    url = f"{GEMINI_API_BASE}/v1beta/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
+    headers = {"Content-Type": "application/json"}
+    data = {"contents": [{"parts": [{"text": prompt}]}]}
+
+    limiter = get_limiter(f"gemini:{model_name}")
+    await limiter.acquire()
+    try:
+        resp = await get_http_client().post(url, headers=headers, json=data)
+    except httpx.HTTPError as e:
+        print(f"Query rewrite failed: {e}")
+        return default # Fail safe
+    if resp.status_code != 200:
+        if resp.status_code == 429:
+            limiter.penalize(parse_retry_after(resp.headers, resp.text))
+        return default # Fail safe
+
+    try:
+        return resp.json()['candidates'][0]['content']['parts'][0]['text']
+    except:
+        return default
 
 def generate_search_query(history, user_input):
     if not history: return user_input
@@ -131,59 +261,276 @@ def generate_search_query(history, user_input):
     response = get_gemini_response_sync(prompt)
     return response.strip().strip('"')
 
-def search_web(query):
+# Rewrites only need the gist of the last turn or two
+REWRITE_HISTORY_BUDGET = int(os.getenv("REWRITE_HISTORY_BUDGET", "300"))
+
+async def generate_search_query_async(history, user_input):
+    if not history: return user_input
+    # Follow-ups like "explain in detail" only make sense with the conversation
+    prompt = (
+        f"Conversation so far:\n{build_history(history, budget=REWRITE_HISTORY_BUDGET, max_message_tokens=100)}\n\n"
+        f"Create a standalone web search query for the user's next message. "
+        f"Reply with the query only.\nNext message: {user_input}"
+    )
+    response = await get_gemini_response(prompt, default=user_input)
+    return response.strip().strip('"')
+
+TAVILY_SEARCH_URL = f"{TAVILY_API_BASE}/search"
+
+# Search cache: popular queries repeat constantly and advanced search is paid quota
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "900"))
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+register_cache("search", search_cache)
+
+def normalize_query(query):
+    # Case, whitespace and trailing punctuation don't change what Tavily returns
+    query = re.sub(r'\s+', ' ', query.strip().lower())
+    return query.rstrip('?!. ')
+
+async def _fetch_search(query, search_depth, max_results):
+    # Tavily REST call on the shared pooled client, so a slow search
+    # never blocks the event loop the way the sync SDK client did.
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {TAVILY_API_KEY}"}
+    data = {"query": query, "search_depth": search_depth, "max_results": max_results}
+    limiter = get_limiter("tavily")
+    await limiter.acquire()
+    resp = await get_http_client().post(TAVILY_SEARCH_URL, headers=headers, json=data)
+    if resp.status_code != 200:
+        if resp.status_code == 429:
+            limiter.penalize(parse_retry_after(resp.headers, resp.text))
+        raise Exception(f"Search API Error {resp.status_code}: {resp.text}")
+    return resp.json().get('results', [])
+
+# Reranking keeps the prompt small, so we can afford to ask Tavily for more results
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "5"))
+
+async def search_web_async(query, search_depth="advanced", max_results=None):
+    max_results = max_results or SEARCH_MAX_RESULTS
+    key = (normalize_query(query), search_depth, max_results)
     try:
-        response = tavily.search(query=query, search_depth="advanced", max_results=5)
-        return response['results']
-    except:
+        results = await search_cache.get_or_fetch(
+            key, lambda: _fetch_search(query, search_depth, max_results)
+        )
+        # Callers may annotate results; never hand out the cached list itself
+        return [dict(r) for r in results]
+    except Exception as e:
+        print(f"Search failed: {e}")
         return []
 
+# Multi-query mode: split a complex question into sub-queries and search them concurrently
+MULTI_QUERY_ENABLED = os.getenv("MULTI_QUERY_ENABLED", "false").lower() == "true"
+MULTI_QUERY_MAX = int(os.getenv("MULTI_QUERY_MAX", "3"))
+MULTI_QUERY_DEADLINE = float(os.getenv("MULTI_QUERY_DEADLINE", "8"))
+TRACKING_PARAMS = ("utm_", "ref=", "fbclid=", "gclid=")
+
+def looks_multi_part(question):
+    # Cheap gate so simple questions don't pay for the split call
+    q = question.lower()
+    return q.count("?") > 1 or " and " in q or " vs " in q or " versus " in q or len(q.split()) > 15
+
+async def generate_sub_queries(history, user_input, max_queries=MULTI_QUERY_MAX):
+    if not looks_multi_part(user_input):
+        return [await generate_search_query_async(history, user_input)]
+    prompt = (
+        f"Split this question into at most {max_queries} independent web search queries, "
+        f"one per line, no numbering or extra text:\n{user_input}"
+    )
+    if history:
+        # "compare that with X and Y": each query has to say what "that" is
+        prompt = (
+            f"Conversation so far:\n{build_history(history, budget=REWRITE_HISTORY_BUDGET, max_message_tokens=100)}\n\n"
+            f"Split the user's next message into at most {max_queries} independent, standalone web search "
+            f"queries, one per line, no numbering or extra text.\nNext message: {user_input}"
+        )
+    response = await get_gemini_response(prompt, default="")
+    queries = [q.strip().strip('-*"').strip() for q in response.splitlines()]
+    queries = [q for q in queries if q][:max_queries]
+    return queries or [await generate_search_query_async(history, user_input)]
+
+def canonical_url(url):
+    """Lowercase host, no www/fragment/tracking params/trailing slash, for dedup."""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = "&".join(sorted(
+        p for p in parts.query.split("&")
+        if p and not p.lower().startswith(TRACKING_PARAMS)
+    ))
+    path = parts.path.rstrip("/")
+    return f"{host}{path}" + (f"?{query}" if query else "")
+
+def merge_results(result_lists, limit=None):
+    """Interleaves ranked result lists round-robin, keeping the first hit per canonical URL."""
+    merged, seen = [], set()
+    for rank in range(max((len(r) for r in result_lists), default=0)):
+        for results in result_lists:
+            if rank >= len(results):
+                continue
+            key = canonical_url(results[rank]['url'])
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(results[rank])
+    return merged[:limit] if limit else merged
+
+async def search_multi(queries, deadline=MULTI_QUERY_DEADLINE):
+    """
+    Runs one search per query concurrently and merges whatever finished
+    within `deadline` seconds; stragglers are cancelled.
+    """
+    if len(queries) == 1:
+        return await search_web_async(queries[0])
+    tasks = [asyncio.create_task(search_web_async(q)) for q in queries]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    if pending:
+        print(f"Multi-query search: {len(pending)} of {len(tasks)} missed the {deadline}s deadline")
+    # Keep query order so the first sub-query's top hits lead the interleave
+    return merge_results([t.result() for t in tasks if t in done])
+
+# Model routing: per-model latency/error tracking, circuit breakers and optional hedging
+model_router = ModelRouter(
+    ["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.0-flash-exp"],
+    stream_gemini_rest,
+    failure_threshold=int(os.getenv("MODEL_BREAKER_FAILURES", "3")),
+    cooldown=float(os.getenv("MODEL_BREAKER_COOLDOWN", "30")),
+    hedge=os.getenv("MODEL_HEDGING", "false").lower() == "true",
+    hedge_percentile=float(os.getenv("MODEL_HEDGE_PERCENTILE", "0.9")),
+    observer=observe_model,
+)
+
+# Prompt size drives Gemini latency and cost; long sources get trimmed to this
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1000"))
+HISTORY_MESSAGE_TOKENS = int(os.getenv("HISTORY_MESSAGE_TOKENS", "300"))
+# Source text size above which passage reranking runs in a worker thread
+RERANK_OFFLOAD_CHARS = int(os.getenv("RERANK_OFFLOAD_CHARS", "50000"))
+
 def extract_youtube_id(url):
     pattern = r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/)([\w-]+)'
     match = re.search(pattern, url)
     if match: return match.group(1)
     return None
 
-async def generate_response_stream(query, search_results, history=[]):
+async def generate_response_stream(query, search_results, history=[], score_query=None):
     # Context
     from datetime import datetime
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    context_text = "\n\n".join([f"Source: {r['title']}\nURL: {r['url']}\nContent: {r['content']}" for r in search_results])
+    # Passages are ranked against the refined search query when there is one:
+    # a follow-up like "explain in detail" has no topic terms of its own
+    score_query = score_query or query
+    # BM25 over a large result set is real CPU work; keep it off the event loop
+    with span("context"):
+        if sum(len(r.get('content', '')) for r in search_results) > RERANK_OFFLOAD_CHARS:
+            context_text = await asyncio.to_thread(
+                build_context, score_query, search_results, CONTEXT_TOKEN_BUDGET, bm25_score
+            )
+        else:
+            context_text = build_context(score_query, search_results, budget=CONTEXT_TOKEN_BUDGET, score_fn=bm25_score)
     
+    # history is the summary plus the last few turns (history.history_window)
+    history_text = ""
+    if history:
+        history_text = "Conversation so far:\n" + build_history(
+            history, budget=HISTORY_TOKEN_BUDGET, max_message_tokens=HISTORY_MESSAGE_TOKENS
+        ) + "\n"
+
     prompt = f"""
     System: You are an expert AI assistant.
     Current Date and Time: {current_time}
-    
+    {history_text}
     Answer the question using the context below.
     Context: {context_text}
     Question: {query}
     """
     
-    # Try User Requested "2.5 Flash" (Verified from API List)
+    # Router picks 2.5 Flash first (Verified from API List), then falls back.
+    # A model is only abandoned if it fails before sending any text; once we
+    # have streamed part of an answer we can't restart it on another model.
     try:
-        # Exact name from verified_models.json
-        full_text = await run_gemini_rest("gemini-2.5-flash", prompt, stream=False)
-        
+        async for model_name, text in model_router.stream(prompt):
+            yield text
+    except AllModelsFailed as e:
+        yield f"\n\n[System Error: All models (2.5 Flash, 2.5 Pro, 2.0 Flash) failed. Details: {str(e)}]"
     except Exception as e:
-        print(f"Primary gemini-2.5-flash failed: {e}")
-        
-        # Try 2.5 Pro (Alternative high quality)
-        try:
-             print("Switching to Fallback: gemini-2.5-pro")
-             full_text = await run_gemini_rest("gemini-2.5-pro", prompt, stream=False)
-        except Exception as e2:
-             print(f"Fallback gemini-2.5-pro failed: {e2}")
-             
-             # Ultimate Fallback: 2.0 Flash Exp (Known working previously)
-             try:
-                 print("Switching to Ultimate Fallback: gemini-2.0-flash-exp")
-                 full_text = await run_gemini_rest("gemini-2.0-flash-exp", prompt, stream=False)
-             except Exception as e3:
-                 yield f"\n\n[System Error: All models (2.5 Flash, 2.5 Pro, 2.0 Flash) failed. Details: {str(e3)}]"
-                 return
-
-    # Simulate stream for frontend
-    chunk_size = 20
-    for i in range(0, len(full_text), chunk_size):
-        yield full_text[i:i+chunk_size]
-        await asyncio.sleep(0.01)
+        print(f"Generation interrupted: {e}")
+        yield f"\n\n[System Error: Generation was interrupted. Details: {str(e)}]"
+
+# Answer cache: suggestion prompts and trending topics produce many
+# near-identical first-turn questions that would each cost a model call.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+answer_cache = AnswerCache(
+    maxsize=int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+    ttl=int(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.7")),
+)
+register_cache("answers", answer_cache)
+ERROR_MARKER = "[System Error"
+
+async def cached_response_stream(query, search_results, history=[], score_query=None):
+    """
+    generate_response_stream with the near-duplicate answer cache in front.
+    Only first-turn questions are cached; follow-ups depend on the conversation.
+    """
+    if not ANSWER_CACHE_ENABLED or history:
+        async for chunk in generate_response_stream(query, search_results, history, score_query):
+            yield chunk
+        return
+
+    urls = [r['url'] for r in search_results]
+    cached = answer_cache.lookup(query, urls)
+    if cached is not None:
+        chunk_size = 64
+        for i in range(0, len(cached), chunk_size):
+            yield cached[i:i+chunk_size]
+            await asyncio.sleep(0)  # let other streams interleave
+        return
+
+    full_text = ""
+    async for chunk in generate_response_stream(query, search_results, history, score_query):
+        full_text += chunk
+        yield chunk
+    if full_text and ERROR_MARKER not in full_text:
+        answer_cache.store(query, urls, full_text)
+
+async def answer_pipeline(user_query, history=[], multi_query=None):
+    """
+    Full answer for one chat turn: rewrite, search, then generation.
+    Yields ("sources", results) once, followed by ("text", chunk) items.
+    multi_query overrides MULTI_QUERY_ENABLED for this request.
+    """
+    if multi_query is None:
+        multi_query = MULTI_QUERY_ENABLED
+
+    if multi_query:
+        with span("rewrite"):
+            queries = await generate_sub_queries(history, user_query)
+        print(f"Sub-queries: {queries}")
+        with span("search"):
+            search_results = await search_multi(queries)
+        score_query = " ".join(queries)
+    else:
+        with span("rewrite"):
+            refined_query = await generate_search_query_async(history, user_query)
+        print(f"Refined Query: {refined_query}")
+        with span("search"):
+            search_results = await search_web_async(refined_query)
+        score_query = refined_query
+    yield "sources", search_results
+
+    async for chunk in cached_response_stream(user_query, search_results, history, score_query):
+        yield "text", chunk
+
+# Identical first-turn questions arriving together share one pipeline run
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+coalescer = Coalescer()
+
+def answer_stream(user_query, history=[], multi_query=None):
+    """answer_pipeline, coalesced with any identical first-turn request in flight."""
+    if not COALESCE_ENABLED or history:
+        return answer_pipeline(user_query, history, multi_query)
+    key = (normalize_query(user_query), multi_query)
+    return coalescer.subscribe(key, lambda: answer_pipeline(user_query, history, multi_query))
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from tasks import spawn
+
+# Resumable Server-Sent Events for chat answers.
+# Each answer gets a stream id; every event is numbered and kept in a
+# bounded replay buffer, so a client that drops can reconnect with
+# Last-Event-ID and pick up where it left off instead of asking for a
+# fresh generation. Finished streams are kept for a short while.
+
+SSE_REPLAY_EVENTS = int(os.getenv("SSE_REPLAY_EVENTS", "2048"))
+SSE_STREAM_RETENTION = float(os.getenv("SSE_STREAM_RETENTION", "120"))
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "1000"))
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "2000"))
+# What happens to a generation once its last client disconnects:
+# "continue" finishes and saves it in the background, "cancel" stops the
+# upstream calls. Clients can pick per request. Resumable streams get a
+# short grace period before being cancelled so a reconnect can catch them.
+CHAT_ON_DISCONNECT = os.getenv("CHAT_ON_DISCONNECT", "continue")
+CHAT_CANCEL_GRACE = float(os.getenv("CHAT_CANCEL_GRACE", "3"))
+DISCONNECT_POLICIES = ("continue", "cancel")
+
+class ReplayGap(Exception):
+    """The requested events have already been dropped from the replay buffer."""
+
+def format_event(event_id, kind, data):
+    return f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def parse_event_id(event_id):
+    """"<stream_id>:<n>" -> (stream_id, n), or (None, None) if malformed."""
+    stream_id, _, n = (event_id or "").rpartition(":")
+    try:
+        return (stream_id or None), int(n)
+    except ValueError:
+        return None, None
+
+class EventStream:
+    """Typed events of one answer, with the last `maxlen` kept for replay."""
+    def __init__(self, stream_id, maxlen=SSE_REPLAY_EVENTS, on_disconnect=CHAT_ON_DISCONNECT):
+        self.id = stream_id
+        self.events = deque(maxlen=maxlen)  # (n, kind, data)
+        self.next = 0
+        self.done = False
+        self.finished_at = None
+        self.subscribers = 0
+        self.clients = 0  # HTTP responses attached via StreamRegistry.follow
+        self.on_disconnect = on_disconnect
+        self.task = None
+        self.changed = asyncio.Condition()
+
+    @property
+    def oldest(self):
+        return self.events[0][0] if self.events else self.next
+
+    async def publish(self, kind, data):
+        async with self.changed:
+            self.events.append((self.next, kind, data))
+            self.next += 1
+            self.changed.notify_all()
+
+    async def close(self):
+        async with self.changed:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self.changed.notify_all()
+
+    def can_resume(self, after):
+        return after + 1 >= self.oldest
+
+    async def subscribe(self, after=-1):
+        """Yields (n, kind, data) for every event after `after`, live until the stream closes."""
+        self.subscribers += 1
+        try:
+            position = after + 1
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: position < self.next or self.done)
+                    if position < self.oldest:
+                        raise ReplayGap(f"events before {self.oldest} are no longer buffered")
+                    batch = [e for e in self.events if e[0] >= position]
+                    position = self.next
+                    finished = self.done
+                for event in batch:
+                    yield event
+                if finished and position == self.next:
+                    return
+        finally:
+            self.subscribers -= 1
+
+    async def sse(self, after=-1):
+        """The stream rendered as SSE text, starting after event `after`."""
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        try:
+            async for n, kind, data in self.subscribe(after):
+                yield format_event(f"{self.id}:{n}", kind, data)
+        except ReplayGap as e:
+            yield format_event(f"{self.id}:{self.next - 1}", "error", {"message": str(e), "code": "replay_gap"})
+
+class StreamRegistry:
+    """Live and recently finished streams by id, bounded in count and age."""
+    def __init__(self, retention=SSE_STREAM_RETENTION, max_streams=SSE_MAX_STREAMS):
+        self.retention = retention
+        self.max_streams = max_streams
+        self.streams = {}
+        self.resumed = 0
+        self.cancelled = 0
+        self.continued = 0
+
+    def _sweep(self):
+        now = time.monotonic()
+        for stream_id, stream in list(self.streams.items()):
+            if stream.done and now - stream.finished_at > self.retention:
+                del self.streams[stream_id]
+        # Over the cap: drop the oldest finished streams first
+        finished = sorted((s for s in self.streams.values() if s.done), key=lambda s: s.finished_at)
+        while len(self.streams) >= self.max_streams and finished:
+            del self.streams[finished.pop(0).id]
+
+    def create(self, stream_id, producer, on_disconnect=CHAT_ON_DISCONNECT):
+        """Registers a stream and runs producer(stream) as a background task."""
+        self._sweep()
+        stream = self.streams[stream_id] = EventStream(stream_id, on_disconnect=on_disconnect)
+        stream.task = spawn(producer(stream))
+        return stream
+
+    async def follow(self, stream, body, grace=0.0):
+        """
+        Passes an HTTP response body through, noticing when the client goes
+        away. If it was the stream's last client and the stream is set to
+        "cancel", the producer is cancelled after `grace` seconds unless
+        someone has reattached by then.
+        """
+        stream.clients += 1
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            stream.clients -= 1
+            if stream.clients == 0 and not stream.done:
+                if stream.on_disconnect == "cancel":
+                    if grace > 0:
+                        asyncio.get_running_loop().call_later(grace, self._cancel_if_abandoned, stream)
+                    else:
+                        self._cancel_if_abandoned(stream)
+                else:
+                    self.continued += 1
+
+    def _cancel_if_abandoned(self, stream):
+        if stream.clients == 0 and not stream.done and stream.task is not None:
+            self.cancelled += 1
+            stream.task.cancel()
+
+    def cancel_prefix(self, prefix):
+        """Cancels every live stream whose id starts with `prefix`; returns their tasks."""
+        tasks = [
+            s.task for s in self.streams.values()
+            if s.id.startswith(prefix) and not s.done and s.task is not None
+        ]
+        for task in tasks:
+            task.cancel()
+        self.cancelled += len(tasks)
+        return tasks
+
+    def get(self, stream_id):
+        self._sweep()
+        return self.streams.get(stream_id)
+
+    def stats(self):
+        live = sum(1 for s in self.streams.values() if not s.done)
+        return {
+            "streams": len(self.streams),
+            "live": live,
+            "subscribers": sum(s.subscribers for s in self.streams.values()),
+            "resumed": self.resumed,
+            "cancelled": self.cancelled,
+            "continued": self.continued,
+        }
+
+registry = StreamRegistry()
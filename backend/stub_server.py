@@ -0,0 +1,231 @@
+"""
+Offline stand-in for the Tavily search API and the Gemini REST API.
+
+Run it, then start the backend with UPSTREAM_STUB_URL pointing at it:
+
+    python stub_server.py --port 8090 --profile realistic
+    UPSTREAM_STUB_URL=http://127.0.0.1:8090 uvicorn main:app --port 8005
+
+Profiles set latency distributions, token rates and error/429 injection;
+--model lets one model misbehave (e.g. --model gemini-2.5-flash=degraded)
+to exercise fallbacks, breakers and hedging.
+"""
+import json
+import random
+import asyncio
+import argparse
+import hashlib
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Latencies are in milliseconds; "latency" is (distribution, mean, spread).
+PROFILES = {
+    "instant": {
+        "search_latency": ("fixed", 0, 0),
+        "first_token_latency": ("fixed", 0, 0),
+        "tokens_per_second": 0,  # 0 = no pacing
+        "error_rate": 0.0,
+        "rate_limit_rate": 0.0,
+    },
+    "realistic": {
+        "search_latency": ("lognormal", 1800, 0.4),
+        "first_token_latency": ("lognormal", 700, 0.35),
+        "tokens_per_second": 120,
+        "error_rate": 0.01,
+        "rate_limit_rate": 0.01,
+    },
+    "degraded": {
+        "search_latency": ("lognormal", 4000, 0.6),
+        "first_token_latency": ("lognormal", 6000, 0.5),
+        "tokens_per_second": 30,
+        "error_rate": 0.3,
+        "rate_limit_rate": 0.1,
+    },
+    "down": {
+        "search_latency": ("fixed", 100, 0),
+        "first_token_latency": ("fixed", 100, 0),
+        "tokens_per_second": 0,
+        "error_rate": 1.0,
+        "rate_limit_rate": 0.0,
+    },
+}
+
+WORDS = (
+    "the results indicate that recent research shows a clear trend across sources "
+    "experts note significant progress while several studies highlight open questions "
+    "in practice this means teams should consider tradeoffs carefully"
+).split()
+
+config = {
+    "profile": dict(PROFILES["realistic"]),
+    "models": {},           # model name -> profile overrides
+    "answer_tokens": 300,
+    "results": 5,
+    "retry_after": 2,
+    "seed": None,
+}
+rng = random.Random()
+stats = {"search": 0, "generate": 0, "stream": 0, "errors": 0, "rate_limited": 0}
+
+app = FastAPI()
+
+def sample_ms(spec):
+    kind, mean, spread = spec
+    if kind == "fixed" or mean <= 0:
+        return max(0.0, mean)
+    if kind == "normal":
+        return max(0.0, rng.gauss(mean, spread))
+    if kind == "lognormal":
+        # spread is sigma of the underlying normal; mean stays ~mean
+        return rng.lognormvariate(0, spread) * mean
+    if kind == "uniform":
+        return rng.uniform(max(0.0, mean - spread), mean + spread)
+    raise ValueError(f"Unknown distribution: {kind}")
+
+def profile_for(model=None):
+    profile = dict(config["profile"])
+    if model and model in config["models"]:
+        profile.update(config["models"][model])
+    return profile
+
+def injected_failure(profile):
+    """Returns an error response to send instead of a result, or None."""
+    roll = rng.random()
+    if roll < profile["rate_limit_rate"]:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(config["retry_after"])},
+            content={"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                               "message": "Stub quota exceeded"}},
+        )
+    if roll < profile["rate_limit_rate"] + profile["error_rate"]:
+        stats["errors"] += 1
+        return JSONResponse(status_code=503, content={"error": {"code": 503, "message": "Stub overloaded"}})
+    return None
+
+def fake_answer(prompt):
+    # Deterministic per prompt, so answer-cache and coalescing runs are comparable
+    local = random.Random(hashlib.md5(prompt.encode()).hexdigest())
+    return [local.choice(WORDS) + " " for _ in range(config["answer_tokens"])]
+
+def candidate(text):
+    return {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}}]}
+
+@app.post("/search")
+async def search(request: Request):
+    body = await request.json()
+    stats["search"] += 1
+    profile = profile_for()
+    await asyncio.sleep(sample_ms(profile["search_latency"]) / 1000)
+    failure = injected_failure(profile)
+    if failure:
+        return failure
+    query = body.get("query", "")
+    slug = hashlib.md5(query.lower().encode()).hexdigest()[:8]
+    n = min(body.get("max_results") or config["results"], 20)
+    results = [{
+        "title": f"Result {i + 1} for {query}",
+        "url": f"https://example-{i % 3}.com/{slug}/{i}",
+        "content": " ".join(fake_answer(f"{query}-{i}")[:120]),
+        "score": round(1 - i / (n + 1), 3),
+    } for i in range(n)]
+    return {"query": query, "results": results, "response_time": 0}
+
+@app.post("/v1beta/models/{model_action}")
+async def gemini(model_action: str, request: Request):
+    model, _, action = model_action.partition(":")
+    body = await request.json()
+    prompt = "".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+    profile = profile_for(model)
+
+    await asyncio.sleep(sample_ms(profile["first_token_latency"]) / 1000)
+    failure = injected_failure(profile)
+    if failure:
+        return failure
+
+    tokens = fake_answer(prompt)
+    tps = profile["tokens_per_second"]
+
+    if action == "generateContent":
+        stats["generate"] += 1
+        if tps:
+            await asyncio.sleep(len(tokens) / tps)
+        return candidate("".join(tokens))
+
+    if action != "streamGenerateContent":
+        return JSONResponse(status_code=404, content={"error": {"code": 404, "message": f"Unknown action {action}"}})
+
+    stats["stream"] += 1
+    sse = request.query_params.get("alt") == "sse"
+    chunk_tokens = 8
+
+    async def body_stream():
+        chunks = [tokens[i:i + chunk_tokens] for i in range(0, len(tokens), chunk_tokens)]
+        if not sse:
+            yield "["
+        for i, chunk in enumerate(chunks):
+            if tps and i:
+                await asyncio.sleep(len(chunk) / tps)
+            payload = json.dumps(candidate("".join(chunk)))
+            if sse:
+                yield f"data: {payload}\r\n\r\n"
+            else:
+                yield ("," if i else "") + payload + "\n"
+        if not sse:
+            yield "]"
+
+    media_type = "text/event-stream" if sse else "application/json"
+    return StreamingResponse(body_stream(), media_type=media_type)
+
+@app.get("/stub/stats")
+async def stub_stats():
+    return {"stats": stats, "config": config}
+
+@app.post("/stub/config")
+async def stub_config(payload: dict):
+    # Lets a benchmark switch profiles mid-run, e.g. {"models": {"gemini-2.5-flash": {"error_rate": 1}}}
+    if "profile" in payload:
+        config["profile"] = dict(PROFILES[payload["profile"]])
+    for key in ("answer_tokens", "results", "retry_after"):
+        if key in payload:
+            config[key] = payload[key]
+    for model, overrides in payload.get("models", {}).items():
+        config["models"][model] = PROFILES[overrides] if isinstance(overrides, str) else overrides
+    return config
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline Tavily + Gemini stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--profile", default="realistic", choices=sorted(PROFILES))
+    parser.add_argument("--model", action="append", default=[],
+                        help="Per-model profile, e.g. gemini-2.5-flash=degraded")
+    parser.add_argument("--answer-tokens", type=int, default=300)
+    parser.add_argument("--results", type=int, default=5)
+    parser.add_argument("--retry-after", type=float, default=2)
+    parser.add_argument("--error-rate", type=float, help="Override the profile's error rate")
+    parser.add_argument("--rate-limit-rate", type=float, help="Override the profile's 429 rate")
+    parser.add_argument("--tokens-per-second", type=float, help="Override the profile's token rate")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    config["profile"] = dict(PROFILES[args.profile])
+    for name in ("error_rate", "rate_limit_rate", "tokens_per_second"):
+        if getattr(args, name) is not None:
+            config["profile"][name] = getattr(args, name)
+    for spec in args.model:
+        model, _, profile = spec.partition("=")
+        config["models"][model] = dict(PROFILES[profile])
+    config["answer_tokens"] = args.answer_tokens
+    config["results"] = args.results
+    config["retry_after"] = args.retry_after
+    if args.seed is not None:
+        config["seed"] = args.seed
+        rng.seed(args.seed)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
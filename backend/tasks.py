@@ -0,0 +1,14 @@
+import asyncio
+
+# The event loop only keeps weak references to tasks, so a fire-and-forget
+# task with nothing else pointing at it can be garbage collected mid-run.
+# spawn() holds on to it until it finishes.
+
+_background = set()
+
+def spawn(coro):
+    """asyncio.create_task that keeps the task alive until it's done."""
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
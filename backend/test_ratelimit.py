@@ -0,0 +1,56 @@
+import time
+import asyncio
+import threading
+from ratelimit import RateLimiter
+
+# Retry-After has to hold back callers that were already queued when it
+# arrived, not just the ones that come after it.
+
+def test_penalize_holds_back_queued_callers():
+    async def run():
+        limiter = RateLimiter("test", 60, burst=1)
+        start = time.monotonic()
+        fired = []
+
+        async def call():
+            await limiter.acquire()
+            fired.append(time.monotonic() - start)
+
+        callers = [asyncio.create_task(call()) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        limiter.penalize(1)
+        await asyncio.gather(*callers)
+        return fired
+
+    fired = asyncio.run(run())
+    # The first one went out before the penalty; the others wait it out
+    # and still go one per second afterwards
+    assert fired[0] < 0.1
+    assert fired[1] >= 1.1, fired
+    assert fired[2] - fired[1] >= 0.9, fired
+
+def test_penalize_holds_back_queued_sync_callers():
+    limiter = RateLimiter("test", 60, burst=1)
+    start = time.monotonic()
+    fired = []
+
+    def call():
+        limiter.acquire_sync()
+        fired.append(time.monotonic() - start)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    limiter.penalize(1)
+    for t in threads:
+        t.join()
+    fired.sort()
+    assert fired[0] < 0.1
+    assert fired[1] >= 1.1, fired
+    assert fired[2] - fired[1] >= 0.9, fired
+
+if __name__ == "__main__":
+    test_penalize_holds_back_queued_callers()
+    test_penalize_holds_back_queued_sync_callers()
+    print("ok")